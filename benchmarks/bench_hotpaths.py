@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bench_hotpaths.py
+#
+# Micro-benchmarks for the parsing and formatting hot paths in charrington, run against
+# synthetic contact feeds (see synthetic.py) so that no Google account is needed.
+#
+# For each size (1k, 10k and 100k contacts by default) this times
+#
+#   feed_parse           gdata parsing the raw feed XML into its object tree (which
+#                        charrington no longer does, kept as a point of reference)
+#   parse_contacts_feed  charrington parsing the raw feed XML into Contacts
+#   make_contact         turning every (already parsed) feed entry into a Contact
+#   parse_address        parsing every (already parsed) postal address
+#   format_contact_bbdb  formatting every contact as a BBDB record
+#   output_bbdb_file     writing a whole BBDB file (through an OutputSink to a file)
+#   output_bbdb_jobs     the same, formatting with a pool of --jobs processes
+#   output_mutt_aliases  writing a whole mutt aliases file (likewise)
+#
+# Each measurement is the best of several repeats. Results are saved as JSON under
+# benchmarks/results/ (or wherever --save says), and passing an earlier results file
+# with --compare prints the change for every measurement, e.g.
+#
+#     python benchmarks/bench_hotpaths.py --save before.json
+#     ... make some changes ...
+#     python benchmarks/bench_hotpaths.py --compare before.json
+
+import os
+import sys
+import gc
+import json
+import time
+import timeit
+import shutil
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import xml.etree.cElementTree as ElementTree
+
+import atom.core
+import gdata.contacts.data
+import charrington
+import synthetic
+
+
+BENCHMARKS = ["feed_parse", "parse_contacts_feed", "make_contact", "parse_address", "format_contact_bbdb",
+              "output_bbdb_file", "output_bbdb_jobs", "output_mutt_aliases"]
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# gdata's object tree for 100k contacts doesn't fit comfortably in memory, so feeds are
+# generated and parsed in chunks of this many contacts and the timings added up
+CHUNK_SIZE = 10000
+
+
+def best_of(repeat, func):
+    """Return the fastest of repeat timings of func(), in seconds."""
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def time_output(repeat, tmpdir, func, contacts, *args):
+    """Time writing contacts to a new file with one of the output functions."""
+    path = os.path.join(tmpdir, "output")
+
+    def write():
+        if os.path.exists(path):
+            os.remove(path)
+        with charrington.OutputSink(path) as out:
+            func(contacts, out, *args)
+    return best_of(repeat, write)
+
+
+def run_chunk(start, stop, density, repeat, groups, timings):
+    """Time parsing contacts start to stop, add the timings up, and return the contacts."""
+    xml = synthetic.feed("contacts", [synthetic.contact_entry("bench@example.com", i, density)
+                                      for i in range(start, stop)])
+    timings["feed_parse"] += best_of(repeat, lambda: atom.core.parse(xml, gdata.contacts.data.ContactsFeed))
+    timings["parse_contacts_feed"] += best_of(repeat, lambda: charrington.parse_contacts_feed(xml, groups))
+    entries = ElementTree.fromstring(xml).findall(charrington.ATOM + "entry")
+    timings["make_contact"] += best_of(repeat, lambda: [charrington.make_contact(e) for e in entries])
+    addrs = [addr for e in entries for addr in e.iterfind(charrington.GD + "structuredPostalAddress")]
+    timings["parse_address"] += best_of(repeat, lambda: [charrington.parse_address(a) for a in addrs])
+    return [entry.contact for entry in charrington.parse_contacts_feed(xml, groups)[0]]
+
+
+def run_size(count, density, repeat, jobs, tmpdir):
+    """Run every benchmark for an address book of count contacts and return the timings."""
+    timings = dict((name, 0.0) for name in BENCHMARKS)
+    groups = {}
+    for element in atom.core.parse(synthetic.groups_feed(), gdata.contacts.data.GroupsFeed).entry:
+        cg = charrington.ContactGroup()
+        cg.href = element.id.text
+        cg.name = element.title.text
+        cg.is_system = bool(element.system_group)
+        groups[cg.href] = cg
+
+    contacts = []
+    for start in range(0, count, CHUNK_SIZE):
+        contacts.extend(run_chunk(start, min(count, start + CHUNK_SIZE), density, repeat, groups, timings))
+
+    contacts.sort(key=lambda x: x.last_name.lower())
+    timings["format_contact_bbdb"] = best_of(repeat, lambda: [charrington.format_contact_bbdb(c) for c in contacts])
+    timings["output_bbdb_file"] = time_output(repeat, tmpdir, charrington.output_bbdb_file, contacts)
+    timings["output_bbdb_jobs"] = time_output(repeat, tmpdir, charrington.output_bbdb_file, contacts, jobs)
+    timings["output_mutt_aliases"] = time_output(repeat, tmpdir, charrington.output_mutt_aliases, contacts)
+    return timings
+
+
+def print_results(results, baseline=None):
+    """Print a table of results, with the change from baseline if there is one."""
+    header = "{:<22} {:>8} {:>11} {:>13}".format("benchmark", "contacts", "seconds", "us/contact")
+    if baseline:
+        header += " {:>10}".format("change")
+    print(header)
+    for name in BENCHMARKS:
+        for size in sorted(results["timings"], key=int):
+            secs = results["timings"][size][name]
+            line = "{:<22} {:>8} {:>11.4f} {:>13.2f}".format(name, size, secs, 1e6 * secs / int(size))
+            before = baseline and baseline["timings"].get(size, {}).get(name)
+            if before:
+                line += " {:>+9.1f}%".format(100.0 * (secs - before) / before)
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark charrington's parsing and formatting hot paths")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Comma separated list of address book sizes (default 1000,10000,100000).")
+    parser.add_argument("--repeat", type=int, default=3, help="Repeats per measurement; the best is kept (default 3).")
+    parser.add_argument("--jobs", type=int, default=4, help="Processes for output_bbdb_jobs (default 4).")
+    parser.add_argument("--phones", type=int, default=3, help="Maximum phone numbers per contact.")
+    parser.add_argument("--addresses", type=int, default=2, help="Maximum postal addresses per contact.")
+    parser.add_argument("--emails", type=int, default=3, help="Maximum email addresses per contact.")
+    parser.add_argument("--groups", type=int, default=4, help="Maximum group memberships per contact.")
+    parser.add_argument("--non-ascii", type=float, default=0.5, help="Fraction of contacts with non-ASCII names.")
+    parser.add_argument("--save", metavar="FILE", help="Where to save the results (default benchmarks/results/).")
+    parser.add_argument("--compare", metavar="FILE", help="Earlier results file to compare against.")
+    args = parser.parse_args()
+
+    density = synthetic.Density(phones=args.phones, addresses=args.addresses, emails=args.emails,
+                                groups=args.groups, non_ascii=args.non_ascii)
+    results = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "machine": platform.node(),
+               "density": vars(density),
+               "repeat": args.repeat,
+               "jobs": args.jobs,
+               "timings": {}}
+    tmpdir = tempfile.mkdtemp(prefix="charrington-bench")
+    try:
+        for size in [int(x) for x in args.sizes.split(",")]:
+            sys.stderr.write("running {} contacts...\n".format(size))
+            results["timings"][str(size)] = run_size(size, density, args.repeat, args.jobs, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    save = args.save
+    if not save:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        save = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(save, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    sys.stderr.write("results saved to {}\n".format(save))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bench_sync.py
+#
+# End-to-end timing of full charrington syncs against the mock Contacts server (see
+# mock_server.py). The server is started in this process, and for every combination of
+# account count, groups per account and worker count, charrington is run as a separate
+# process with a fresh home directory (so nothing is reused from earlier runs unless
+# --warm is given) and a ~/.charringtonrc pointing every account at the mock server.
+#
+#     python benchmarks/bench_sync.py --accounts 1,4,12 --groups 1,4 --latency 100
+#
+# Results (wall time, and the requests and bytes the server handled) are printed and
+# saved as JSON, and can be compared against an earlier run with --compare, just like
+# bench_hotpaths.py.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import synthetic
+import mock_server
+
+
+CHARRINGTON = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "charrington.py")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def write_config(home, server, accounts, groups):
+    """Write a ~/.charringtonrc with the given number of accounts and groups per account."""
+    with open(os.path.join(home, ".charringtonrc"), "w") as f:
+        for n in range(accounts):
+            login = "user%d@example.com" % n
+            hrefs = [synthetic.group_href(login, synthetic.FIRST_USER_GROUP + g) for g in range(groups)]
+            f.write("[Account%d]\nlogin = %s\npassword = secret\nserver = %s\ngroups = %s\n\n"
+                    % (n, login, server.url, ", ".join(hrefs)))
+
+
+def run_sync(home, extra_args):
+    """Run charrington once with the given home directory, and return the wall time."""
+    env = dict(os.environ, HOME=home)
+    output = os.path.join(home, "bbdb")
+    start = time.time()
+    subprocess.check_call([sys.executable, CHARRINGTON, "--output", output] + extra_args, env=env)
+    return time.time() - start
+
+
+def run_case(server, accounts, groups, workers, args):
+    """Time syncs for one combination, returning the best wall time and the server's counters."""
+    times = []
+    stats = {}
+    home = tempfile.mkdtemp(prefix="charrington-e2e")
+    try:
+        write_config(home, server, accounts, groups)
+        for i in range(args.repeat):
+            if not args.warm and os.path.exists(os.path.join(home, ".charrington")):
+                shutil.rmtree(os.path.join(home, ".charrington"))
+            before = dict(server.stats)
+            times.append(run_sync(home, ["-w", str(workers), "--page-size", str(args.page_size)] + args.extra))
+            stats = dict((k, v - before.get(k, 0)) for k, v in server.stats.items())
+    finally:
+        shutil.rmtree(home)
+    return {"accounts": accounts, "groups": groups, "workers": workers, "seconds": min(times), "server": stats}
+
+
+def case_key(case):
+    return "a%d-g%d-w%d" % (case["accounts"], case["groups"], case["workers"])
+
+
+def print_results(results, baseline=None):
+    """Print a table of results, with the change from baseline if there is one."""
+    before = dict((case_key(c), c) for c in baseline["cases"]) if baseline else {}
+    header = "{:>8} {:>7} {:>8} {:>9} {:>9} {:>6} {:>11}".format("accounts", "groups", "workers", "seconds",
+                                                                  "requests", "conns", "kbytes")
+    if baseline:
+        header += " {:>10}".format("change")
+    print(header)
+    for case in results["cases"]:
+        requests = sum(v for k, v in case["server"].items() if k.endswith("_requests") or k == "logins")
+        line = "{:>8} {:>7} {:>8} {:>9.3f} {:>9} {:>6} {:>11.1f}".format(case["accounts"], case["groups"],
+                                                                       case["workers"], case["seconds"], requests,
+                                                                       case["server"].get("connections", 0),
+                                                                       case["server"].get("bytes", 0) / 1024.0)
+        if case_key(case) in before:
+            old = before[case_key(case)]["seconds"]
+            line += " {:>+9.1f}%".format(100.0 * (case["seconds"] - old) / old)
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time full charrington syncs against the mock Contacts server")
+    parser.add_argument("--accounts", default="1,4,12", help="Comma separated account counts (default 1,4,12).")
+    parser.add_argument("--groups", default="1,4", help="Comma separated groups per account (default 1,4).")
+    parser.add_argument("--workers", default="1,8", help="Comma separated values for charrington -w (default 1,8).")
+    parser.add_argument("--contacts", type=int, default=2000, help="Contacts per account (default 2000).")
+    parser.add_argument("--page-size", type=int, default=500, help="charrington --page-size (default 500).")
+    parser.add_argument("--latency", type=float, default=50.0, help="Milliseconds added to every request (default 50).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more milliseconds, at random.")
+    parser.add_argument("--rate", type=float, default=0.0, help="Requests per second per account before 503s.")
+    parser.add_argument("--max-page", type=int, default=1000, help="Most entries the server returns per page.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 500.")
+    parser.add_argument("--repeat", type=int, default=1, help="Syncs per combination; the fastest is kept.")
+    parser.add_argument("--warm", action="store_true",
+                        help="Keep charrington's saved state (logins, sync state) between repeats.")
+    parser.add_argument("--save", metavar="FILE", help="Where to save the results (default benchmarks/results/).")
+    parser.add_argument("--compare", metavar="FILE", help="Earlier results file to compare against.")
+    parser.add_argument("extra", nargs="*", help="Extra arguments passed to charrington (after --).")
+    args = parser.parse_args()
+
+    options = mock_server.MockOptions(contacts=args.contacts, groups=max(int(g) for g in args.groups.split(",")),
+                                      latency=args.latency / 1000.0, jitter=args.jitter / 1000.0, rate=args.rate,
+                                      max_page=args.max_page, error_rate=args.error_rate)
+    server = mock_server.MockContactsServer(("127.0.0.1", 0), options)
+    server.start()
+
+    results = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "machine": platform.node(),
+               "options": dict(vars(options), density=vars(options.density)),
+               "page_size": args.page_size,
+               "extra": args.extra,
+               "cases": []}
+    for accounts in [int(x) for x in args.accounts.split(",")]:
+        for groups in [int(x) for x in args.groups.split(",")]:
+            for workers in [int(x) for x in args.workers.split(",")]:
+                sys.stderr.write("syncing {} accounts x {} groups with {} workers...\n".format(accounts, groups, workers))
+                results["cases"].append(run_case(server, accounts, groups, workers, args))
+    server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    save = args.save
+    if not save:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        save = os.path.join(RESULTS_DIR, "sync-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(save, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    sys.stderr.write("results saved to {}\n".format(save))
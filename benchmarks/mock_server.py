@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# mock_server.py
+#
+# A local stand-in for the parts of the Google Contacts API that charrington uses:
+# ClientLogin, the groups feed, the (paginated) contacts feed and single contacts.
+# Every login is accepted, and each account is filled with synthetic groups and
+# contacts (see synthetic.py), so the whole network path can be exercised and timed
+# without a Google account.
+#
+# Feeds carry an ETag, and requests that send it back in If-None-Match get a 304 Not
+# Modified when the feed hasn't changed, as Google's do. Responses are gzipped for
+# clients that accept it, and connections are kept alive between requests.
+#
+# With --churn, some of the contacts change a while after the server starts (they're
+# edited, deleted, or removed from a group), and feeds asking for changes since some
+# time (updated-min) include them, along with placeholders for the deleted ones if they
+# ask for those (showdeleted), so incremental syncs and --daemon can be tried out too.
+#
+# To make the network path interesting, the server can add latency to every request,
+# throttle each account to a number of requests per second (answering 503, like
+# Google does when a quota is exceeded), cap the page size, and fail a fraction of
+# requests with server errors.
+#
+# Run it with
+#
+#     python benchmarks/mock_server.py --port 8080 --contacts 5000 --latency 100
+#
+# and point an account in your ~/.charringtonrc at it with
+#
+#     server = http://localhost:8080
+#
+# Group IDs look just like Google's: group 6 is "My Contacts" and the user groups are
+# numbered from 10, e.g. http://www.google.com/m8/feeds/groups/LOGIN/base/10 (with the
+# @ in LOGIN written as %40).
+
+import re
+import sys
+import zlib
+import time
+import random
+import hashlib
+import urllib
+import urlparse
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import synthetic
+
+
+FEED_PATH = re.compile(r"^/m8/feeds/(contacts|groups)/([^/]+)/(full|base|thin)(?:/([0-9a-f]+))?$")
+
+
+class MockOptions(object):
+    """The shape of the mock accounts and the misbehaviour of the server.
+
+    contacts and groups are the number of contacts and user groups in every account.
+    latency (in seconds) is added to every request, plus up to jitter more at random.
+    rate is the number of requests per second each account may make before getting
+    503s (0 for no limit), max_page caps the number of entries per page, and
+    error_rate is the fraction of requests that fail with a 500.
+
+    churn is the fraction of contacts that change (are edited, deleted, or removed
+    from a group; see synthetic.contact_change) churn_after seconds after the server
+    starts, so that incremental syncs have something to pick up.
+    """
+    def __init__(self, contacts=1000, groups=8, density=synthetic.DEFAULT_DENSITY, latency=0.0, jitter=0.0,
+                 rate=0.0, max_page=1000, error_rate=0.0, seed=0, churn=0.0, churn_after=0.0):
+        self.contacts = contacts
+        self.groups = groups
+        self.density = density
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.max_page = max_page
+        self.error_rate = error_rate
+        self.seed = seed
+        self.churn = churn
+        self.churn_after = churn_after
+
+
+class MockContactsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server answering Contacts API requests with synthetic data."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, options, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockContactsHandler)
+        self.options = options
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.members = {}
+        self.buckets = {}
+        self.stats = {}
+        self.random = random.Random(options.seed)
+        self.changes_by_login = {}
+        self.change_time = time.time() + options.churn_after
+        self.changed_at = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(self.change_time))
+
+    @property
+    def url(self):
+        return "http://%s:%d" % (self.server_address[0], self.server_address[1])
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def group_members(self, login, href):
+        """Return the indices of the contacts of an account that are in a group, in order."""
+        with self.lock:
+            if login not in self.members:
+                members = {}
+                for index in xrange(self.options.contacts):
+                    for group in synthetic.contact_groups(login, index, self.options.density,
+                                                          self.options.groups, self.options.seed):
+                        members.setdefault(group, []).append(index)
+                self.members[login] = members
+            return self.members[login].get(href, [])
+
+    def changes(self, login):
+        """Return {index: change} for the contacts of an account that have changed by now."""
+        if not self.options.churn or time.time() < self.change_time:
+            return {}
+        with self.lock:
+            if login not in self.changes_by_login:
+                changes = {}
+                for index in xrange(self.options.contacts):
+                    change = synthetic.contact_change(login, index, self.options.churn, self.options.seed)
+                    if change:
+                        changes[index] = change
+                self.changes_by_login[login] = changes
+            return self.changes_by_login[login]
+
+    def throttled(self, login):
+        """Take a token from the account's bucket, returning True if there wasn't one."""
+        if not self.options.rate:
+            return False
+        with self.lock:
+            now = time.time()
+            tokens, last = self.buckets.get(login, (self.options.rate, now))
+            tokens = min(self.options.rate, tokens + (now - last) * self.options.rate)
+            if tokens < 1:
+                self.buckets[login] = (tokens, now)
+                return True
+            self.buckets[login] = (tokens - 1, now)
+            return False
+
+    def start(self):
+        """Serve requests on a background thread, and return the thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class MockContactsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count("connections")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def respond(self, status, body, content_type="application/atom+xml; charset=UTF-8", version=None):
+        if status == 200 and self.command == "GET":
+            # feeds are validated by ETag, so unchanged ones can be answered with a 304;
+            # version is what the ETag covers, if not the whole body
+            etag = '"%s"' % hashlib.sha1(body if version is None else version).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.server.count("status_304")
+                return
+            self.send_response(status)
+            self.send_header("ETag", etag)
+        else:
+            self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count("bytes", len(body))
+        self.server.count("status_%d" % status)
+
+    def misbehave(self, login):
+        """Apply latency and injected failures; return True if the request was answered."""
+        options = self.server.options
+        if options.latency or options.jitter:
+            time.sleep(options.latency + self.server.random.random() * options.jitter)
+        if login and self.server.throttled(login):
+            self.respond(503, "Quota exceeded. Please retry later.", "text/plain")
+            return True
+        if options.error_rate and self.server.random.random() < options.error_rate:
+            self.respond(500, "Internal error (injected by mock server)", "text/plain")
+            return True
+        return False
+
+    def authenticated_login(self):
+        """Return the login of the token in the request's Authorization header, or None."""
+        match = re.match(r"GoogleLogin auth=mock-(.+)$", self.headers.get("Authorization", ""))
+        return match and urllib.unquote(match.group(1))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse.urlparse(self.path).path != "/accounts/ClientLogin":
+            return self.respond(404, "Not found", "text/plain")
+        self.server.count("logins")
+        form = urlparse.parse_qs(body)
+        login = form.get("Email", [""])[0]
+        if self.misbehave(login):
+            return
+        if not login:
+            return self.respond(403, "Error=BadAuthentication\n", "text/plain")
+        token = "mock-" + urllib.quote(login)
+        self.respond(200, "SID=%s\nLSID=%s\nAuth=%s\n" % (token, token, token), "text/plain")
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        match = FEED_PATH.match(url.path)
+        if not match:
+            return self.respond(404, "Not found", "text/plain")
+        kind, user, projection, entry_id = match.groups()
+        login = self.authenticated_login()
+        if login is None:
+            return self.respond(401, "Token invalid", "text/plain")
+        if user != "default" and urllib.unquote(user) != login:
+            return self.respond(403, "Forbidden", "text/plain")
+        self.server.count(kind + "_requests")
+        if self.misbehave(login):
+            return
+
+        options = self.server.options
+        if kind == "groups":
+            return self.respond(200, synthetic.groups_feed(login, options.groups))
+        if entry_id is not None:
+            index = int(entry_id, 16) - 0x1000
+            change = self.server.changes(login).get(index)
+            if not 0 <= index < options.contacts or change == synthetic.DELETED:
+                return self.respond(404, "Contact not found", "text/plain")
+            return self.respond(200, synthetic.entry_document(self.contact_entry(login, index, change)))
+        self.contacts_feed(login, url)
+
+    def contact_entry(self, login, index, change):
+        """Return the XML of a contact as it is after the given change (see MockContactsServer.changes)."""
+        options = self.server.options
+        if change == synthetic.DELETED:
+            return synthetic.deleted_entry(login, index, self.server.changed_at)
+        if change == synthetic.TOUCHED:
+            return synthetic.contact_entry(login, index, options.density, options.groups, options.seed,
+                                           updated=self.server.changed_at, revision=1)
+        if change == synthetic.LEFT_GROUP:
+            left = synthetic.left_groups(login, index, options.density, options.groups, options.seed)
+            return synthetic.contact_entry(login, index, options.density, options.groups, options.seed,
+                                           updated=self.server.changed_at, left=left)
+        return synthetic.contact_entry(login, index, options.density, options.groups, options.seed)
+
+    def contacts_feed(self, login, url):
+        """Answer a request for a page of the contacts feed."""
+        options = self.server.options
+        params = dict(urlparse.parse_qsl(url.query))
+        group = params.get("group")
+        start = max(1, int(params.get("start-index", 1)))
+        size = min(options.max_page, int(params.get("max-results", 25)))
+        updated_min = params.get("updated-min", "")[:19]
+        show_deleted = params.get("showdeleted") == "true"
+        changes = self.server.changes(login)
+
+        def listed(index):
+            change = changes.get(index)
+            if updated_min:
+                # changes since then, with placeholders for deleted contacts only if asked for
+                updated = self.server.changed_at if change else synthetic.updated_time(index)
+                return updated[:19] >= updated_min and (change != synthetic.DELETED or show_deleted)
+            if change == synthetic.LEFT_GROUP:
+                return group not in synthetic.left_groups(login, index, options.density, options.groups, options.seed)
+            return change != synthetic.DELETED
+
+        if group:
+            indices = self.server.group_members(login, group)
+        else:
+            indices = xrange(options.contacts)
+        if updated_min or changes:
+            indices = [i for i in indices if listed(i)]
+        page = indices[start - 1:start - 1 + size]
+
+        links = []
+        if start - 1 + size < len(indices):
+            params["start-index"] = str(start + size)
+            params["max-results"] = str(size)
+            links.append(("next", "%s%s?%s" % (self.server.url, url.path, urllib.urlencode(sorted(params.items())))))
+        self.server.count("entries", len(page))
+        entries = [self.contact_entry(login, i, changes.get(i)) for i in page]
+        # like Google's, the feed's updated time is when it was served, which clients use
+        # as updated-min next time; it isn't a change to the feed, so the ETag leaves it out
+        now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+        version = (u"%d %d %r " % (len(indices), start, links) + u"".join(entries)).encode("utf-8")
+        self.respond(200, synthetic.feed("contacts", entries, total=len(indices), start_index=start,
+                                         links=links, updated=now), version=version)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic Google Contacts feeds for testing charrington")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default 8080).")
+    parser.add_argument("--contacts", type=int, default=1000, help="Contacts per account (default 1000).")
+    parser.add_argument("--groups", type=int, default=8, help="User groups per account (default 8).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds added to every request.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many more milliseconds, at random.")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Requests per second allowed per account before answering 503 (default no limit).")
+    parser.add_argument("--max-page", type=int, default=1000, help="Most entries returned per page (default 1000).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 500.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data.")
+    parser.add_argument("--churn", type=float, default=0.0,
+                        help="Fraction of contacts edited, deleted or removed from a group after --churn-after.")
+    parser.add_argument("--churn-after", type=float, default=30.0, metavar="SECONDS",
+                        help="Seconds after starting that the --churn changes happen (default 30).")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    options = MockOptions(contacts=args.contacts, groups=args.groups, latency=args.latency / 1000.0,
+                          jitter=args.jitter / 1000.0, rate=args.rate, max_page=args.max_page,
+                          error_rate=args.error_rate, seed=args.seed, churn=args.churn, churn_after=args.churn_after)
+    server = MockContactsServer((args.host, args.port), options, args.verbose)
+    sys.stderr.write("serving synthetic contacts on %s\n" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# startup.py
+#
+# Checks that the commands that only work with local files start quickly. Each one is
+# run as a separate process (in a scratch home directory, so there's nothing to sync
+# from) to make sure it never imports the network side of charrington (gdata and
+# friends, see GoogleBackend in charrington.py), and timed to make sure it stays within
+# a budget on top of the bare interpreter's own startup time.
+#
+#     python benchmarks/startup.py --budget 100
+#
+# Exits with status 1 if any command imports something it shouldn't or is too slow,
+# so it can be run as a check after changing charrington's imports.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+CHARRINGTON = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "charrington.py")
+
+# modules that are only needed to talk to Google
+REMOTE_MODULES = ("gdata", "atom", "httplib", "multiprocessing")
+
+# the local-only command lines to check
+COMMANDS = [["--help"],
+            ["--no-such-option"],
+            ["-q", "smith"],
+            ["-o", "--output", "out.bbdb"],
+            ["-o", "-m"]]
+
+# runs charrington in the child process, then reports which modules it loaded
+RUNNER = """
+import sys, json, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+finally:
+    with open(%r, "w") as f:
+        json.dump(sorted(name for name, module in sys.modules.items() if module is not None), f)
+"""
+
+
+def run(home, argv):
+    """Run python with argv in the scratch home directory, returning the wall time."""
+    env = dict(os.environ, HOME=home)
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        subprocess.call([sys.executable] + argv, env=env, cwd=home, stdout=devnull, stderr=devnull)
+        return time.time() - start
+
+
+def median_time(home, argv, repeat):
+    times = sorted(run(home, argv) for i in range(repeat))
+    return times[len(times) // 2]
+
+
+def remote_modules(home, args):
+    """Return the network-only modules charrington loads when run with args."""
+    report = os.path.join(home, "modules.json")
+    run(home, ["-c", RUNNER % report, CHARRINGTON] + args)
+    with open(report) as f:
+        modules = json.load(f)
+    return [m for m in modules if m.split(".")[0] in REMOTE_MODULES]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that charrington's local commands start quickly")
+    parser.add_argument("--budget", type=float, default=100.0,
+                        help="Most milliseconds each command may add to the interpreter's startup (default 100).")
+    parser.add_argument("--repeat", type=int, default=9, help="Runs per command; the median is kept (default 9).")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="charrington-startup")
+    failed = False
+    try:
+        open(os.path.join(home, ".charringtonrc"), "w").close()
+        baseline = median_time(home, ["-c", "pass"], args.repeat)
+        print("{:<32} {:>10}  {}".format("command", "ms", "remote modules loaded"))
+        print("{:<32} {:>10.1f}".format("(bare interpreter)", baseline * 1000))
+        for command in COMMANDS:
+            elapsed = median_time(home, [CHARRINGTON] + command, args.repeat)
+            loaded = remote_modules(home, command)
+            overhead = (elapsed - baseline) * 1000
+            ok = not loaded and overhead <= args.budget
+            failed = failed or not ok
+            print("{:<32} {:>+10.1f}  {}{}".format(" ".join(command), overhead, ", ".join(loaded) or "none",
+                                                   "" if ok else "   FAIL"))
+    finally:
+        shutil.rmtree(home)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# synthetic.py
+#
+# Generates synthetic Google Contacts feeds (in the Atom format the Contacts API v3
+# returns) for benchmarking and load testing charrington without a Google account.
+#
+# Everything is derived from a seed, the account login, and the index of the contact,
+# so the same contact always comes out the same, no matter which page it's on or which
+# process generated it.
+
+import random
+
+
+ATOM_NAMESPACES = ("xmlns='http://www.w3.org/2005/Atom' "
+                   "xmlns:openSearch='http://a9.com/-/spec/opensearch/1.1/' "
+                   "xmlns:gd='http://schemas.google.com/g/2005' "
+                   "xmlns:gContact='http://schemas.google.com/contact/2008' "
+                   "xmlns:batch='http://schemas.google.com/gdata/batch'")
+
+SCHEMA = "http://schemas.google.com/g/2005#"
+
+GIVEN_NAMES = [u"John", u"Mary", u"José", u"Zoë", u"Björn", u"François", u"Ana", u"Łukasz",
+               u"Søren", u"Mei", u"Jürgen", u"Amélie", u"Dmitri", u"Chloé", u"Oğuz", u"Priya"]
+FAMILY_NAMES = [u"Smith", u"Müller", u"García", u"O'Neil", u"Nguyễn", u"Kowalski", u"Dubois",
+                u"Johansson", u"Zhang", u"Ødegård", u"Rossi", u"Novák", u"Brown", u"Çelik"]
+CITIES = [u"Springfield", u"Zürich", u"Málaga", u"Kraków", u"Montréal", u"Tromsø", u"Portland"]
+STREETS = [u"Main St", u"Bahnhofstraße", u"Calle Mayor", u"Rue de la Paix", u"Elm Avenue"]
+PHONE_RELS = ["mobile", "home", "work", "main", "work_fax"]
+OTHER_RELS = ["home", "work", "other"]
+SYSTEM_GROUP = 6
+FIRST_USER_GROUP = 10
+
+
+class Density(object):
+    """How much detail each synthetic contact has.
+
+    phones, addresses, emails and groups are the maximum number of each per contact
+    (the actual number is picked at random from 0 up to the maximum; every contact has
+    at least one email address). non_ascii is the fraction of contacts whose names and
+    addresses are drawn from the full list of (mostly non-ASCII) names rather than
+    plain ASCII ones, and multiline is the fraction of addresses with a two-line street.
+    """
+    def __init__(self, phones=3, addresses=2, emails=3, groups=4, non_ascii=0.5, multiline=0.5):
+        self.phones = phones
+        self.addresses = addresses
+        self.emails = emails
+        self.groups = groups
+        self.non_ascii = non_ascii
+        self.multiline = multiline
+
+
+DEFAULT_DENSITY = Density()
+
+
+def quote_login(login):
+    """Return a login the way it appears inside feed URIs."""
+    return login.replace("@", "%40")
+
+
+def group_href(login, number, server="http://www.google.com"):
+    """Return the Atom id of a contact group."""
+    return "%s/m8/feeds/groups/%s/base/%d" % (server, quote_login(login), number)
+
+
+def contact_href(login, index, server="http://www.google.com"):
+    """Return the Atom id of a contact."""
+    return "%s/m8/feeds/contacts/%s/base/%x" % (server, quote_login(login), 0x1000 + index)
+
+
+def escape(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u"'", u"&apos;")
+
+
+def ascii_only(names):
+    return [name for name in names if all(ord(c) < 128 for c in name)]
+
+
+def contact_groups(login, index, density=DEFAULT_DENSITY, ngroups=8, seed=0):
+    """Return the hrefs of the groups a contact belongs to (always including My Contacts)."""
+    rnd = random.Random("%s/%s/%d/groups" % (seed, login, index))
+    hrefs = [group_href(login, SYSTEM_GROUP)]
+    for number in rnd.sample(range(ngroups), min(ngroups, rnd.randint(0, density.groups))):
+        hrefs.append(group_href(login, FIRST_USER_GROUP + number))
+    return hrefs
+
+
+# the ways a contact can change after it was first generated (see contact_change)
+TOUCHED = "touched"
+DELETED = "deleted"
+LEFT_GROUP = "left group"
+
+
+def contact_change(login, index, fraction, seed=0):
+    """Return how a contact changes later on: TOUCHED, DELETED, LEFT_GROUP or None.
+
+    fraction of the contacts change at all, split evenly between being edited (they
+    come out differently, see contact_entry's revision), deleted, and removed from the
+    last of their groups (see left_groups).
+    """
+    r = random.Random("%s/%s/%d/change" % (seed, login, index)).random()
+    if r >= fraction:
+        return None
+    return (TOUCHED, DELETED, LEFT_GROUP)[min(2, int(3 * r / fraction))]
+
+
+def left_groups(login, index, density=DEFAULT_DENSITY, ngroups=8, seed=0):
+    """Return the hrefs of the groups a contact that changes with LEFT_GROUP leaves."""
+    return contact_groups(login, index, density, ngroups, seed)[-1:]
+
+
+def updated_time(index):
+    """Return the (made up) time a contact was last updated, as an RFC 3339 string."""
+    return "20%02d-%02d-%02dT%02d:%02d:%02d.%03dZ" % (10 + index % 10, 1 + index % 12, 1 + index % 28,
+                                                      index % 24, index % 60, (index * 7) % 60, index % 1000)
+
+
+def contact_entry(login, index, density=DEFAULT_DENSITY, ngroups=8, seed=0, updated=None, revision=0, left=()):
+    """Return the XML of a single contact entry, as a unicode string.
+
+    updated overrides the contact's usual updated time. Each revision of a contact has
+    different details (revision 0 being the original), and the groups in left are
+    listed as memberships that have been deleted.
+    """
+    rnd = random.Random("%s/%s/%d" % (seed, login, index) + ("/%d" % revision if revision else ""))
+    fancy = rnd.random() < density.non_ascii
+    given = rnd.choice(GIVEN_NAMES if fancy else ascii_only(GIVEN_NAMES))
+    family = rnd.choice(FAMILY_NAMES if fancy else ascii_only(FAMILY_NAMES))
+    if updated is None:
+        updated = updated_time(index)
+    xml = [u"<entry><id>%s</id><updated>%s</updated>" % (contact_href(login, index), updated),
+           u"<category scheme='http://schemas.google.com/g/2005#kind' "
+           u"term='http://schemas.google.com/contact/2008#contact'/>",
+           u"<title>%s %s</title>" % (escape(given), escape(family)),
+           u"<gd:name><gd:fullName>%s %s</gd:fullName><gd:givenName>%s</gd:givenName>"
+           % (escape(given), escape(family), escape(given))]
+    if rnd.random() < 0.1:
+        xml.append(u"<gd:additionalName>%s</gd:additionalName>" % escape(rnd.choice(GIVEN_NAMES)))
+    xml.append(u"<gd:familyName>%s</gd:familyName></gd:name>" % escape(family))
+    if rnd.random() < 0.3:
+        xml.append(u"<gd:organization rel='%swork'><gd:orgName>%s Corp</gd:orgName></gd:organization>"
+                   % (SCHEMA, escape(rnd.choice(FAMILY_NAMES))))
+    for n in range(max(1, rnd.randint(0, density.emails))):
+        xml.append(u"<gd:email rel='%s%s' address='%s.%s%d@example%d.com'%s/>"
+                   % (SCHEMA, rnd.choice(OTHER_RELS), u"user" if fancy else given.lower(),
+                      n, index, rnd.randint(0, 9), u" primary='true'" if n == 0 else u""))
+    for n in range(rnd.randint(0, density.phones)):
+        xml.append(u"<gd:phoneNumber rel='%s%s'>+1 %03d-%03d-%04d</gd:phoneNumber>"
+                   % (SCHEMA, rnd.choice(PHONE_RELS), rnd.randint(200, 999), rnd.randint(0, 999),
+                      rnd.randint(0, 9999)))
+    for n in range(rnd.randint(0, density.addresses)):
+        street = u"%d %s" % (rnd.randint(1, 999), rnd.choice(STREETS if fancy else ascii_only(STREETS)))
+        if rnd.random() < density.multiline:
+            street += u"\nApt %d" % rnd.randint(1, 99)
+        xml.append(u"<gd:structuredPostalAddress rel='%s%s'><gd:street>%s</gd:street>"
+                   % (SCHEMA, rnd.choice(OTHER_RELS), escape(street)))
+        if rnd.random() < 0.2:
+            xml.append(u"<gd:neighborhood>Old Town</gd:neighborhood>")
+        xml.append(u"<gd:city>%s</gd:city><gd:region>CA</gd:region><gd:postcode>%05d</gd:postcode>"
+                   u"<gd:country>United States</gd:country></gd:structuredPostalAddress>"
+                   % (escape(rnd.choice(CITIES if fancy else ascii_only(CITIES))), rnd.randint(0, 99999)))
+    for href in contact_groups(login, index, density, ngroups, seed):
+        xml.append(u"<gContact:groupMembershipInfo deleted='%s' href='%s'/>"
+                   % ("true" if href in left else "false", href))
+    xml.append(u"</entry>")
+    return u"".join(xml)
+
+
+def deleted_entry(login, index, updated):
+    """Return the XML of the placeholder left behind by a deleted contact."""
+    return (u"<entry><id>%s</id><updated>%s</updated><title></title><gd:deleted/></entry>"
+            % (contact_href(login, index), updated))
+
+
+def feed(title, entries, total=None, start_index=1, links=(), updated="2013-01-01T00:00:00.000Z"):
+    """Wrap entry XML strings in an Atom feed and return it encoded as UTF-8.
+
+    links is a sequence of (rel, href) pairs, e.g. the feed's next link. updated is the
+    feed's own updated time, which Google sets to the time it answered.
+    """
+    xml = [u"<?xml version='1.0' encoding='UTF-8'?><feed %s><id>%s</id>" % (ATOM_NAMESPACES, title),
+           u"<updated>%s</updated><title>%s</title>" % (updated, title)]
+    for rel, href in links:
+        xml.append(u"<link rel='%s' type='application/atom+xml' href='%s'/>" % (rel, escape(href)))
+    xml.append(u"<openSearch:totalResults>%d</openSearch:totalResults>"
+               u"<openSearch:startIndex>%d</openSearch:startIndex>" % (total or len(entries), start_index))
+    xml.extend(entries)
+    xml.append(u"</feed>")
+    return u"".join(xml).encode("utf-8")
+
+
+def entry_document(entry):
+    """Turn entry XML into a standalone document (as returned for a single contact), encoded as UTF-8."""
+    return (u"<?xml version='1.0' encoding='UTF-8'?>" +
+            entry.replace(u"<entry>", u"<entry %s>" % ATOM_NAMESPACES, 1)).encode("utf-8")
+
+
+def contacts_feed(count, login="bench@example.com", density=DEFAULT_DENSITY, ngroups=8, seed=0):
+    """Return a contacts feed holding count synthetic contacts, encoded as UTF-8."""
+    return feed("contacts", [contact_entry(login, i, density, ngroups, seed) for i in xrange(count)])
+
+
+def group_entry(login, number):
+    """Return the XML of a contact group entry (group 6 is the "My Contacts" system group)."""
+    if number == SYSTEM_GROUP:
+        return (u"<entry><id>%s</id><updated>2013-01-01T00:00:00.000Z</updated><title>System Group: My Contacts"
+                u"</title><gContact:systemGroup id='Contacts'/></entry>" % group_href(login, number))
+    return (u"<entry><id>%s</id><updated>2013-01-01T00:00:00.000Z</updated><title>Group %d &amp; Friends"
+            u"</title></entry>" % (group_href(login, number), number))
+
+
+def groups_feed(login="bench@example.com", ngroups=8):
+    """Return the groups feed of an account with ngroups user groups, encoded as UTF-8."""
+    numbers = [SYSTEM_GROUP] + [FIRST_USER_GROUP + n for n in range(ngroups)]
+    return feed("groups", [group_entry(login, number) for number in numbers])
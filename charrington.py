@@ -41,9 +41,10 @@
 #
 # Known Issues:
 #
-# It doesn't yet do anything special with duplicates. You can always run bbdb-show-duplicates
-# and fix things after the fact, but they'll reappear as soon as you run charrington
-# again.
+# Duplicates are only combined if you ask for it (-d), and only when they come from different
+# accounts and share an email address or phone number. Otherwise you can always run
+# bbdb-show-duplicates and fix things after the fact, but they'll reappear as soon as you run
+# charrington again.
 #
 # There's no two-way syncing yet. I usually add new contacts infrequently enough that
 # it's not a huge problem to do it via the web interface, but it would be nice to have
@@ -71,21 +72,41 @@
 
 
 import os
+import sys
 import argparse
 import string
 import re
+import json
+import time
+import sched
+import signal
+import random
+import socket
+import heapq
+import hashlib
+import sqlite3
+import cProfile
+import pstats
+import tempfile
+import shutil
+import threading
 import ConfigParser
-import gdata.data
-import gdata.contacts.client
-import gdata.contacts.data
+import xml.etree.cElementTree as ElementTree
+from io import BytesIO
+from collections import OrderedDict
+from contextlib import contextmanager
 
 
-class Contact:
+class Contact(object):
+    # address books can hold tens of thousands of these, so skip the per-instance __dict__
+    __slots__ = ("first_name", "last_name", "nickname", "organization", "phone_numbers",
+                 "addresses", "email", "timestamp", "id", "groups")
+
     def __init__(self):
         self.first_name = ""
         self.last_name = ""
         # Google does have a "nickname" field, but I'm currently not using it
-        self.nickname = []
+        self.nickname = ()
         self.organization = ""
         # list of tuples, each of the form (label, number)
         self.phone_numbers = []
@@ -101,12 +122,33 @@ class Contact:
         self.groups = []
 
 
-class ContactGroup:
+class ContactGroup(object):
+    __slots__ = ("href", "_name", "alias", "is_system")
+
     def __init__(self):
         self.href = ""
         self.name = ""
         self.is_system = False
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        # the mail alias is written for every member of the group, so work it out once here
+        self._name = intern_string(name)
+        self.alias = canonicalize_group_name(self._name)
+
+
+# strings that repeat across many contacts (labels, group names) share a single copy
+_interned = {}
+
+
+def intern_string(s):
+    """Return the shared copy of a string, works for both str and unicode."""
+    return _interned.setdefault(s, s)
+
 
 # fields for phone number records
 PHONE_LABEL = 0
@@ -126,6 +168,598 @@ EMAIL_LABEL = 0
 EMAIL_ADDRESS = 1
 EMAIL_PRIMARY = 2
 
+# charrington keeps its own state (saved login tokens, etc.) under this directory
+STATE_DIR = os.path.expanduser("~/.charrington")
+SESSION_FILE = os.path.join(STATE_DIR, "sessions")
+SYNC_STATE_DIR = os.path.join(STATE_DIR, "sync")
+STORE_FILE = os.path.join(STATE_DIR, "contacts.db")
+CACHE_DIR = os.path.join(STATE_DIR, "cache")
+
+# number of contacts requested per page of a group's contact feed
+PAGE_SIZE = 500
+
+# size of the buffer used when writing output files (in bytes)
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# how long a saved login token is trusted before logging in again (in seconds)
+SESSION_LIFETIME = 24 * 60 * 60
+# number of contacts each process formats at a time with --jobs
+FORMAT_CHUNK_SIZE = 2000
+
+# default number of seconds between polls of each account when running as a daemon
+POLL_INTERVAL = 300
+
+# most contacts a sync holds in memory while sorting them; past that they're spilled to
+# temporary files in sorted runs, and merged back together as they're written out
+SORT_BUDGET = 50000
+# most sorted runs a sync keeps on disk (each is an open temporary file); past that, the
+# newest runs of a stream are merged into one
+MAX_RUNS = 64
+
+# default most megabytes of feed responses to keep in CACHE_DIR (see ResponseCache)
+CACHE_SIZE = 64
+# most idle keep-alive connections kept open to each server (see ConnectionPool)
+MAX_IDLE_CONNECTIONS = 8
+
+# path of outputs that are written to stdout (or --output)
+STDOUT = "-"
+# how hard to retry requests that fail
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+
+# in incremental mode, how old a group's sync state can get before the whole group is
+# downloaded again (in seconds). Google only keeps placeholders for deleted contacts for
+# a limited time, and contacts removed from a group don't always show up as changes.
+FULL_SYNC_INTERVAL = 7 * 24 * 60 * 60
+
+
+class Stats(object):
+    """Per-phase timings and per-account/per-group counters for a run (see --stats and --profile).
+
+    Phases can nest, and each one is only charged for the time not spent in the phases
+    nested inside it, so that, e.g., time spent writing to disk isn't also counted as
+    formatting. Phases running on different worker threads overlap in wall time, so the
+    phase times can add up to more than the total.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self.accounts = OrderedDict()
+        self.profiles = None
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager charging the time spent in its body to the named phase."""
+        stack = self.local.__dict__.setdefault("stack", [])
+        frame = [time.time(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.time() - frame[0]
+            if stack:
+                stack[-1][1] += elapsed
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed - frame[1]
+
+    def count(self, scope, name, n=1):
+        """Add n to a counter; scope is a group id, an account login, or "output"."""
+        with self.lock:
+            counts = self.counts.setdefault(scope, OrderedDict())
+            counts[name] = counts.get(name, 0) + n
+
+    def add_accounts(self, accts):
+        """Note which groups belong to which accounts, so the counters can be reported by account."""
+        for acct in accts:
+            self.accounts[acct["login"]] = (acct["name"], acct.get("groups", []))
+
+    def profiled(self, func):
+        """Wrap func so that, when profiling, calls to it (e.g., on worker threads) are profiled too."""
+        def wrapper(*args):
+            if self.profiles is None:
+                return func(*args)
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args)
+            finally:
+                with self.lock:
+                    self.profiles.append(profiler)
+        return wrapper
+
+    def report(self, out):
+        """Write the timings and counters in human readable form."""
+        out.write("Time per phase (seconds):\n")
+        for name, secs in self.phases.items():
+            out.write("  {:<28} {:>9.3f}\n".format(name, secs))
+        out.write("  {:<28} {:>9.3f}\n".format("total (wall clock)", time.time() - self.started))
+
+        def describe(counts):
+            return ", ".join("{} {}".format(name, n) for name, n in counts.items())
+
+        for login, (name, groups) in self.accounts.items():
+            totals = OrderedDict()
+            for scope in groups + [login]:
+                for counter, n in self.counts.get(scope, {}).items():
+                    totals[counter] = totals.get(counter, 0) + n
+            out.write("Account {}: {}\n".format(name, describe(totals) or "nothing fetched"))
+            for group in groups:
+                out.write("  group {}: {}\n".format(group, describe(self.counts.get(group, {})) or "nothing fetched"))
+        if "output" in self.counts:
+            out.write("Output: {}\n".format(describe(self.counts["output"])))
+
+
+# timings and counters for the current run
+stats = Stats()
+
+
+class TokenBucket(object):
+    """A token bucket limiting one account's request rate.
+
+    Unless the account is configured with a rate, requests aren't limited at all until
+    the server first throttles us; the bucket then starts at half the rate we were going
+    at. Every time the account is throttled the rate is halved, and every successful
+    request wins a little of it back (up to the configured rate), so the account settles
+    at the highest rate its quota actually allows.
+    """
+    MIN_RATE = 0.2
+    GROWTH = 1.05
+
+    def __init__(self, rate=None):
+        self.max_rate = self.rate = rate and float(rate)
+        self.tokens = 1.0
+        self.last = time.time()
+        self.recent = []
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.rate is None:
+                    # keep the last second's worth of requests to know how fast we're going
+                    self.recent = [t for t in self.recent if t > now - 1] + [now]
+                    return
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            with stats.phase("waiting for quota"):
+                time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            if self.rate is None:
+                self.rate = float(len(self.recent))
+                self.last = time.time()
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate *= self.GROWTH
+                if self.max_rate:
+                    self.rate = min(self.max_rate, self.rate)
+
+
+class Scheduler(object):
+    """Paces, limits and retries every request made to the Contacts API.
+
+    Each account gets a token bucket (see TokenBucket) limiting its request rate. On top
+    of that, the number of requests in flight across all accounts is limited, starting at
+    the number of workers: it's halved whenever a request is throttled, and grows back by
+    one for every limit's worth of requests that succeed. Requests that fail with a
+    server error, a quota error or a network error are retried after an exponentially
+    growing, randomly jittered delay (or however long the server asked us to wait).
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    THROTTLE_STATUSES = (429, 503)
+
+    def __init__(self, concurrency=8, retries=MAX_RETRIES):
+        self.cond = threading.Condition()
+        self.max_concurrency = concurrency
+        self.limit = float(concurrency)
+        self.active = 0
+        self.retries = retries
+        self.buckets = {}
+        self.local = threading.local()
+
+    def configure(self, concurrency, accts=()):
+        """Set the maximum concurrency, and the request rate of each account."""
+        with self.cond:
+            self.max_concurrency = concurrency
+            self.limit = float(concurrency)
+            for acct in accts:
+                self.buckets[acct["login"]] = TokenBucket(acct.get("rate"))
+
+    def bucket(self, login):
+        with self.cond:
+            if login not in self.buckets:
+                self.buckets[login] = TokenBucket()
+            return self.buckets[login]
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= max(1, int(self.limit)):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def retry_delay(self, error, attempt):
+        """Return how long to wait before retrying a request, or None if it shouldn't be."""
+        if attempt >= self.retries:
+            return None
+        if isinstance(error, google().RequestError):
+            status = getattr(error, "status", None)
+            if status not in self.RETRY_STATUSES and not is_quota_error(error):
+                return None
+            for name, value in getattr(error, "headers", None) or []:
+                if name.lower() == "retry-after" and value.strip().isdigit():
+                    return min(BACKOFF_MAX, float(value))
+        elif not isinstance(error, (socket.error, google().HTTPException)):
+            return None
+        return random.uniform(0.5, 1.0) * min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+
+    def call(self, login, func, *args, **kwargs):
+        """Call func (which makes one request for the given account) under the scheduler's limits."""
+        # requests made while handling another (e.g., following a redirect) are already scheduled
+        if getattr(self.local, "busy", False):
+            return func(*args, **kwargs)
+        bucket = self.bucket(login)
+        attempt = 0
+        while True:
+            bucket.take()
+            self.acquire()
+            self.local.busy = True
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                throttled = is_quota_error(e)
+                self.local.busy = False
+                self.release(throttled)
+                if throttled:
+                    bucket.throttled()
+                    stats.count(login, "throttled")
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                stats.count(login, "retries")
+                with stats.phase("waiting for quota"):
+                    time.sleep(delay)
+                attempt += 1
+            else:
+                self.local.busy = False
+                self.release()
+                bucket.succeeded()
+                return result
+
+
+def is_quota_error(error):
+    """Return True if a request failed because it went over a rate limit or quota."""
+    status = getattr(error, "status", None)
+    if status in Scheduler.THROTTLE_STATUSES:
+        return True
+    body = getattr(error, "body", None) or ""
+    return status == 403 and ("quota" in body.lower() or "rate limit" in body.lower())
+
+
+# the scheduler all requests to Google go through
+scheduler = Scheduler()
+
+
+class ResponseCache(object):
+    """An on-disk cache of responses, so that feeds can be requested conditionally.
+
+    Responses to GET requests that came with an ETag or Last-Modified header are saved
+    in CACHE_DIR, one file per account and URL. The next request for the same URL asks
+    the server to answer 304 Not Modified if nothing changed since, in which case the
+    saved body is used as if it had just been downloaded again, so an unchanged feed
+    costs a tiny request instead of the whole thing. Once the files take up more than
+    max_size bytes, the least recently used ones are deleted. A max_size of zero turns
+    the cache off.
+    """
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE << 20):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # how much is in the cache, once we've had to look
+        self.size = None
+
+    def configure(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            if os.path.isdir(self.path):
+                self.evict()
+
+    def cache_file(self, login, url):
+        key = hashlib.sha1((login + "\n" + url).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key)
+
+    def get(self, login, url):
+        """Return the (validators, body) saved for a URL, or None if there's nothing saved."""
+        if not self.max_size:
+            return None
+        fname = self.cache_file(login, url)
+        try:
+            with open(fname, "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+            # the modification time is what says how recently the file was used
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if header.get("login") != login or header.get("url") != url:
+            return None
+        return header["validators"], body
+
+    def put(self, login, url, validators, body):
+        """Save the body of a response along with its validators (its ETag and Last-Modified headers)."""
+        if not self.max_size:
+            return
+        header = json.dumps({"login": login, "url": url, "validators": validators})
+        with self.lock:
+            ensure_state_dir(self.path)
+            if self.size is None:
+                self.evict()
+            fname = self.cache_file(login, url)
+            try:
+                self.size -= os.path.getsize(fname)
+            except OSError:
+                pass
+            tmpname = "{}.{}.tmp".format(fname, os.getpid())
+            with open(tmpname, "wb") as f:
+                f.write(header)
+                f.write("\n")
+                f.write(body)
+            os.rename(tmpname, fname)
+            self.size += len(header) + 1 + len(body)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Delete the least recently used files until the cache fits in max_size."""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            fname = os.path.join(self.path, name)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, fname))
+        self.size = sum(size for mtime, size, fname in files)
+        for mtime, size, fname in sorted(files):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            self.size -= size
+            stats.count("output", "cache evictions")
+
+
+# the cache all GET requests to Google go through
+response_cache = ResponseCache()
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections, by (scheme, host, port), shared by every client.
+
+    A connection is taken out of the pool while a request is using it, and put back
+    once its response has been read in full, so all the accounts and worker threads
+    talking to the same server share a handful of connections instead of opening a
+    new one (and, for https, doing a new TLS handshake) for every request.
+    """
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.max_idle = max_idle
+
+    def get(self, key):
+        """Return an idle connection to the server, or None if there isn't one."""
+        with self.lock:
+            idle = self.idle.get(key)
+            return idle.pop() if idle else None
+
+    def put(self, key, connection):
+        """Put a connection whose last response has been read back in the pool."""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+# the connections all requests to Google go over
+connection_pool = ConnectionPool()
+
+
+class GoogleBackend(object):
+    """Everything charrington needs from gdata (and the HTTP stack under it).
+
+    Importing gdata takes longer than everything else charrington does at startup put
+    together, so it's only imported when something actually talks to Google: get the
+    backend with google(), not by importing gdata at the top of the file. Commands
+    that work from local files alone (--help, -q, -o) never load it at all.
+    """
+    def __init__(self):
+        import zlib
+        import httplib
+        import atom.http_core
+        import gdata.gauth
+        import gdata.client
+        import gdata.contacts.client
+
+        self.Error = gdata.client.Error
+        self.Unauthorized = gdata.client.Unauthorized
+        self.RequestError = gdata.client.RequestError
+        self.HTTPException = httplib.HTTPException
+        self.ClientLoginToken = gdata.gauth.ClientLoginToken
+        self.ContactsQuery = gdata.contacts.client.ContactsQuery
+
+        class BufferedResponse(atom.http_core.HttpResponse):
+            """A response that has already been read (and decompressed) off its connection."""
+            def getheader(self, name, default=None):
+                return self._headers.get(name.lower(), default)
+
+            def getheaders(self):
+                return self._headers.items()
+
+        def read_body(response):
+            """Read a response in full, decompressing it as it arrives if it was gzipped."""
+            if (response.getheader("content-encoding") or "").lower() != "gzip":
+                return response.read()
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunks = []
+            while True:
+                chunk = response.read(1 << 16)
+                if not chunk:
+                    break
+                chunks.append(decompressor.decompress(chunk))
+            chunks.append(decompressor.flush())
+            return "".join(chunks)
+
+        class PooledHttpClient(atom.http_core.ProxiedHttpClient):
+            """An HttpClient that sends requests over connections from connection_pool, asking for gzip."""
+            def __init__(self, login):
+                self.login = login
+
+            def _http_request(self, method, uri, headers=None, body_parts=None):
+                if isinstance(uri, (str, unicode)):
+                    uri = atom.http_core.Uri.parse_uri(uri)
+                headers = dict(headers or {})
+                headers["Accept-Encoding"] = "gzip"
+                # Google only compresses responses for clients that say so in their user agent too
+                headers["User-Agent"] = headers.get("User-Agent", "charrington") + " (gzip)"
+                key = (uri.scheme, uri.host, uri.port)
+                connection = connection_pool.get(key)
+                if connection is not None:
+                    try:
+                        return self.send(connection, key, method, uri, headers, body_parts)
+                    except (socket.error, httplib.HTTPException):
+                        # the server closed it while it sat in the pool; try again on a new one
+                        pass
+                stats.count(self.login, "connections opened")
+                connection = self._get_connection(uri, headers=headers)
+                return self.send(connection, key, method, uri, headers, body_parts)
+
+            def send(self, connection, key, method, uri, headers, body_parts):
+                try:
+                    path = str(uri) if connection.host != uri.host else uri._get_relative_path()
+                    connection.putrequest(method, path, skip_accept_encoding=True)
+                    for name, value in headers.iteritems():
+                        connection.putheader(name, value)
+                    connection.endheaders()
+                    for part in body_parts or []:
+                        if part != "":
+                            atom.http_core._send_data_part(part, connection)
+                    response = connection.getresponse()
+                    body = read_body(response)
+                except:
+                    connection.close()
+                    raise
+                if response.will_close:
+                    connection.close()
+                else:
+                    connection_pool.put(key, connection)
+                headers = dict(response.getheaders())
+                if "content-encoding" in headers:
+                    del headers["content-encoding"]
+                    headers["content-length"] = str(len(body))
+                return BufferedResponse(response.status, response.reason, headers, body)
+
+        class CachingHttpClient(PooledHttpClient):
+            """A PooledHttpClient that makes GET requests conditional on what's in the response cache."""
+            def __init__(self, login, cache):
+                PooledHttpClient.__init__(self, login)
+                self.cache = cache
+
+            def request(self, http_request):
+                url = str(http_request.uri)
+                # incremental syncs ask for changes since a different time every run, so
+                # there would never be anything in the cache for them
+                if http_request.method != "GET" or "updated-min" in (http_request.uri.query or {}):
+                    return PooledHttpClient.request(self, http_request)
+                cached = self.cache.get(self.login, url)
+                if cached:
+                    validators, body = cached
+                    if "etag" in validators:
+                        http_request.headers["If-None-Match"] = validators["etag"]
+                    if "last-modified" in validators:
+                        http_request.headers["If-Modified-Since"] = validators["last-modified"]
+                response = PooledHttpClient.request(self, http_request)
+                if response.status == 304 and cached:
+                    stats.count(self.login, "not modified")
+                    return BufferedResponse(200, "OK", {}, body)
+                if response.status == 200:
+                    validators = dict((name, response.getheader(name)) for name in ("etag", "last-modified")
+                                      if response.getheader(name))
+                    if validators:
+                        body = response.read()
+                        self.cache.put(self.login, url, validators, body)
+                        return BufferedResponse(response.status, response.reason, dict(response.getheaders()), body)
+                return response
+
+        class ScheduledContactsClient(gdata.contacts.client.ContactsClient):
+            """A ContactsClient whose requests (including logging in) all go through the scheduler."""
+            def __init__(self, login, **kwargs):
+                gdata.contacts.client.ContactsClient.__init__(self, **kwargs)
+                self.login = login
+                self.http_client = CachingHttpClient(login, response_cache)
+
+            def request(self, *args, **kwargs):
+                return scheduler.call(self.login, gdata.contacts.client.ContactsClient.request, self,
+                                      *args, **kwargs)
+
+            def request_client_login_token(self, *args, **kwargs):
+                return scheduler.call(self.login, gdata.contacts.client.ContactsClient.request_client_login_token,
+                                      self, *args, **kwargs)
+
+        self.ContactsClient = ScheduledContactsClient
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def google():
+    """Return the GoogleBackend, importing gdata the first time it's needed."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = GoogleBackend()
+        return _backend
+
+
+def contact_login(contact):
+    """Return the login of the account a contact came from, as found in its google id."""
+    return google_id_login(contact.id)
+
+
+def google_id_login(google_id):
+    """Return the login of the account a google id belongs to, or None if it doesn't look like one."""
+    match = re.search(r"/m8/feeds/contacts/([^/]+)/", google_id or "")
+    return match.group(1).replace("%40", "@") if match else None
+
 
 def load_config():
     """Reads the user's config file and returns a configuration object."""
@@ -138,29 +772,151 @@ def get_accounts(cp):
     """Takes a configuration object and returns a list of accounts.
 
     Each account is represented as a map containing the account name, login,
-    and password, and if specified, the group IDs on the server."""
+    and password, and if specified, the group IDs on the server, the URL of the
+    server itself, the most requests per second to make to it, and how often to
+    poll it when running as a daemon."""
     accounts = []
     for section in cp.sections():
+        acct = {"name": section,
+                "login": cp.get(section, "login"),
+                "password": cp.get(section, "password")}
         # for each account, parse the list of groups to fetch
         if cp.has_option(section, "groups"):
-            accounts.append({"name": section,
-                             "login": cp.get(section, "login"),
-                             "password": cp.get(section, "password"),
-                             "groups": map(lambda x: x.strip(), cp.get(section, "groups").split(","))})
-        else:
-            accounts.append({"name": section,
-                             "login": cp.get(section, "login"),
-                             "password": cp.get(section, "password")})
+            acct["groups"] = map(lambda x: x.strip(), cp.get(section, "groups").split(","))
+        # accounts can also be pointed at a server other than Google's (mostly for testing)
+        if cp.has_option(section, "server"):
+            acct["server"] = cp.get(section, "server").rstrip("/")
+        # and limited to a different number of requests per second than the default
+        if cp.has_option(section, "rate"):
+            acct["rate"] = cp.getfloat(section, "rate")
+        # and, when running as a daemon, polled on a schedule of its own
+        if cp.has_option(section, "interval"):
+            acct["interval"] = cp.getfloat(section, "interval")
+        accounts.append(acct)
     return accounts
 
 
+def new_client(acct):
+    """Return a new ContactsClient for the given account, not yet logged in.
+
+    If the account has a "server" option (e.g., http://localhost:8080, as used with
+    the mock server in benchmarks/), the client talks to that server instead of Google.
+    """
+    gdc = google().ContactsClient(acct["login"], source='charrington')
+    if "server" in acct:
+        scheme, gdc.server = acct["server"].split("://", 1)
+        gdc.ssl = scheme == "https"
+    return gdc
+
+
+def feed_uri(gdc, kind):
+    """Return the URI of the client's contacts or groups feed."""
+    return gdc.GetFeedUri(kind, scheme="https" if gdc.ssl else "http")
+
+
+def login(acct):
+    """Return a ContactsClient logged in to the given account."""
+    gdc = new_client(acct)
+    with stats.phase("login"):
+        if "server" in acct:
+            gdc.ClientLogin(acct["login"], acct["password"], gdc.source,
+                            auth_url=acct["server"] + "/accounts/ClientLogin")
+        else:
+            gdc.ClientLogin(acct["login"], acct["password"], gdc.source)
+    return gdc
+
+
+def ensure_state_dir(path=STATE_DIR):
+    """Create one of charrington's private state directories if it doesn't already exist."""
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    return path
+
+
+# authenticated clients for the current run, keyed by login
+_sessions = {}
+_sessions_lock = threading.Lock()
+_login_locks = {}
+
+
+def load_saved_sessions():
+    """Return the map of unexpired login tokens saved by previous runs."""
+    try:
+        with open(SESSION_FILE) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    now = time.time()
+    return dict((login, session) for login, session in saved.items() if session.get("expires", 0) > now)
+
+
+def save_sessions(saved):
+    """Write the map of saved login tokens, readable only by the user."""
+    ensure_state_dir()
+    tmpname = SESSION_FILE + ".tmp"
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(saved, f)
+    os.rename(tmpname, SESSION_FILE)
+
+
+def get_session(acct):
+    """Return the authenticated client for an account, logging in only when necessary.
+
+    One client is kept per account for the whole run, so every operation against the
+    account shares a single login. The login token is also saved to disk along with
+    an expiry time, so runs that follow each other closely skip the login entirely.
+    """
+    with _sessions_lock:
+        lock = _login_locks.setdefault(acct["login"], threading.Lock())
+    with lock:
+        gdc = _sessions.get(acct["login"])
+        if gdc is None:
+            saved = load_saved_sessions().get(acct["login"])
+            if saved:
+                gdc = new_client(acct)
+                gdc.auth_token = google().ClientLoginToken(saved["token"])
+            else:
+                gdc = login(acct)
+                with _sessions_lock:
+                    sessions = load_saved_sessions()
+                    sessions[acct["login"]] = {"token": gdc.auth_token.token_string,
+                                               "expires": time.time() + SESSION_LIFETIME}
+                    save_sessions(sessions)
+            _sessions[acct["login"]] = gdc
+        return gdc
+
+
+def drop_session(acct, gdc):
+    """Forget a client whose login token has been rejected by the server."""
+    with _sessions_lock:
+        if _sessions.get(acct["login"]) is gdc:
+            del _sessions[acct["login"]]
+        sessions = load_saved_sessions()
+        if acct["login"] in sessions:
+            del sessions[acct["login"]]
+            save_sessions(sessions)
+
+
+def with_session(acct, func):
+    """Call func with the account's authenticated client and return its result.
+
+    If the server rejects a saved token (it may have been revoked or expired early),
+    the session is dropped and func is retried once after a fresh login.
+    """
+    gdc = get_session(acct)
+    try:
+        return func(gdc)
+    except google().Unauthorized:
+        drop_session(acct, gdc)
+        return func(get_session(acct))
+
+
 def get_all_contact_groups(acct):
     """Take an account and return a map of all contact groups on the server."""
-    gdc = gdata.contacts.client.ContactsClient(source='charrington')
-    gdc.ClientLogin(acct["login"], acct["password"], gdc.source)
-
     cgroups = {}
-    elements = gdc.GetGroups()
+    with stats.phase("group list download"):
+        elements = with_session(acct, lambda gdc: gdc.GetGroups(uri=feed_uri(gdc, "groups")))
     for i, element in enumerate(elements.entry):
         cg = ContactGroup()
         cg.href = element.id.text
@@ -173,65 +929,801 @@ def get_all_contact_groups(acct):
     return cgroups
 
 
-def get_all_contacts(acct, groups):
-    """Take an account and a list of groups and return a list of contacts from matching groups."""
-    gdc = gdata.contacts.client.ContactsClient(source='charrington')
-    gdc.ClientLogin(acct["login"], acct["password"], gdc.source)
+def iter_group_feed(gdc, group, groups, page_size=PAGE_SIZE, updated_min=None):
+    """Yield a group's contact feed one page at a time, following the feed's next links.
 
+    Google caps the number of entries returned per request, and a single huge request
+    is slow to start and has to be held in memory all at once, so the feed is requested
+    page_size entries at a time instead. Each page is yielded as a list of FeedEntry
+    objects (see parse_contacts_feed) along with the page's updated time.
+
+    If updated_min is given, only contacts changed since then are requested, including
+    placeholders for contacts that have been deleted.
+    """
+    # set up a query for the contacts in the current group and fetch them
+    query = google().ContactsQuery()
+    query.max_results = page_size
+    query.group = group
+    if updated_min:
+        query.updated_min = updated_min
+        query.showdeleted = "true"
+        # ask for an error rather than a silently incomplete list of deletions
+        query.AddCustomParameter("requirealldeleted", "true")
+    uri = feed_uri(gdc, "contacts")
+    while uri is not None:
+        # the raw XML is parsed here rather than by gdata (see parse_contacts_feed)
+        with stats.phase("feed download"):
+            xml = gdc.GetFeed(uri, converter=read_response, q=query)
+        with stats.phase("contact parsing"):
+            entries, uri, updated = parse_contacts_feed(xml, groups)
+        # the next link already carries the query's parameters
+        query = None
+        yield entries, updated
+
+
+def read_response(response):
+    """Return the body of an HTTP response (used in place of gdata's XML conversion)."""
+    return response.read()
+
+
+# namespaces of the elements in a contacts feed
+ATOM = "{http://www.w3.org/2005/Atom}"
+GD = "{http://schemas.google.com/g/2005}"
+GCONTACT = "{http://schemas.google.com/contact/2008}"
+
+
+class FeedEntry(object):
+    """An entry in a contacts feed, as returned by parse_contacts_feed.
+
+    Besides the Contact (None if the entry is skipped, as entry_contact decides), this
+    keeps what incremental syncs need to know: the entry's id, whether it's a deleted
+    placeholder, and its group memberships as (href, deleted) pairs.
+    """
+    __slots__ = ("id", "deleted", "memberships", "contact")
+
+
+def parse_contacts_feed(xml, groups):
+    """Parse one page of a contacts feed, returning its FeedEntry list, next page's URI and updated time.
+
+    gdata turns the whole page into a tree of its own objects before handing any of it
+    over, which takes far longer (and far more memory) than anything done with the
+    result. Instead, the raw XML is read with iterparse, and each entry is turned
+    straight into a Contact as soon as it has been read and then emptied, so only one
+    entry's elements exist at a time. The result is exactly what converting gdata's
+    ContactEntry objects would have given. The URI is None on the last page.
+
+    The feed's own updated time is when the server answered, by the server's clock
+    (None if the feed doesn't have one).
+    """
+    entries = []
+    next_uri = None
+    entry_tag, link_tag = ATOM + "entry", ATOM + "link"
+    parser = ElementTree.iterparse(BytesIO(xml))
+    for event, element in parser:
+        # elements are seen as they end, so an entry is complete (children and all) here
+        if element.tag == entry_tag:
+            entry = FeedEntry()
+            entry.id = element.findtext(ATOM + "id")
+            entry.deleted = element.find(GD + "deleted") is not None
+            entry.memberships = [(m.get("href"), m.get("deleted"))
+                                 for m in element.iterfind(GCONTACT + "groupMembershipInfo")]
+            entry.contact = entry_contact(element, groups)
+            entries.append(entry)
+            element.clear()
+        elif element.tag == link_tag and element.get("rel") == "next":
+            # entries only have self, edit and photo links, so this is the feed's own
+            next_uri = element.get("href")
+    # only the feed's own children are searched, so this isn't some entry's updated time
+    return entries, next_uri, parser.root.findtext(ATOM + "updated")
+
+
+def entry_contact(entry, groups):
+    """Return the Contact for a feed entry element, or None if the entry should be skipped."""
+    # I chose to skip any items where there was no name entered.
+    if entry.find(GD + "name") is None:
+        return None
+
+    # create a contact object by parsing the element data
+    con = make_contact(entry)
+
+    # now match the group id against the list of known groups from the server.
+    # if there's a match, add the group's name to the list of groups for the contact.
+    # skip the system groups entirely.
+    for cgroup in entry.iterfind(GCONTACT + "groupMembershipInfo"):
+        href = cgroup.get("href")
+        if href in groups and not groups[href].is_system:
+            con.groups.append(groups[href])
+    return con
+
+
+def iter_group_contacts(gdc, group, groups, page_size=PAGE_SIZE):
+    """Take a logged in client and a group ID and yield the contacts in that group.
+
+    Entries are converted into Contact objects page by page as the feed arrives, so only
+    a single page of the feed is ever held in memory.
+    """
+    for entries, updated in iter_group_feed(gdc, group, groups, page_size):
+        for con in page_contacts(group, entries):
+            yield con
+
+
+def page_contacts(group, entries):
+    """Return the contacts of a page of FeedEntry objects, counting them for --stats."""
+    page = [entry.contact for entry in entries]
+    count_page(group, page)
+    return [con for con in page if con]
+
+
+def count_page(group, page):
+    """Count the contacts fetched from a group, and those that will be skipped, for --stats."""
+    stats.count(group, "fetched", len(page))
+    stats.count(group, "no name", sum(1 for con in page if con is None))
+    stats.count(group, "no email", sum(1 for con in page if con is not None and not con.email))
+
+
+def get_group_contacts(gdc, group, groups, page_size=PAGE_SIZE):
+    """Take a logged in client and a group ID and return a list of the contacts in that group."""
+    return list(iter_group_contacts(gdc, group, groups, page_size))
+
+
+def contact_to_record(con):
+    """Return a contact as a plain dict (with group IDs in place of groups) for saving to disk."""
+    return {"first_name": con.first_name,
+            "last_name": con.last_name,
+            "nickname": con.nickname,
+            "organization": con.organization,
+            "phone_numbers": con.phone_numbers,
+            "addresses": con.addresses,
+            "email": con.email,
+            "timestamp": con.timestamp,
+            "id": con.id,
+            "groups": [group.href for group in con.groups]}
+
+
+def contact_from_record(rec, groups):
+    """Rebuild a Contact from a dict made by contact_to_record, looking its groups up in groups."""
+    con = Contact()
+    con.first_name = rec["first_name"]
+    con.last_name = rec["last_name"]
+    con.nickname = rec["nickname"]
+    con.organization = rec["organization"]
+    con.phone_numbers = [(intern_string(phone[0]),) + tuple(phone[1:]) for phone in rec["phone_numbers"]]
+    con.addresses = [(intern_string(addr[0]),) + tuple(addr[1:]) for addr in rec["addresses"]]
+    con.email = [(intern_string(email[0]), email[1], intern_string(email[2])) for email in rec["email"]]
+    con.timestamp = intern_string(rec["timestamp"])
+    con.id = rec["id"]
+    con.groups = [groups[href] for href in rec["groups"] if href in groups and not groups[href].is_system]
+    return con
+
+
+def sync_state_file(acct, group):
+    """Return the name of the file holding the incremental sync state for a group."""
+    key = hashlib.sha1((acct["login"] + "\n" + group).encode("utf-8")).hexdigest()
+    return os.path.join(SYNC_STATE_DIR, key + ".json")
+
+
+def load_sync_state(acct, group):
+    """Return the saved sync state for a group, or None if there isn't a usable one.
+
+    The state is a map holding the time of the last successful sync ("updated") and
+    the records of every contact the group held at that time ("contacts"), keyed by
+    google id and kept in feed order.
+    """
+    fname = sync_state_file(acct, group)
+    state = _sync_states.get(fname) if _sync_states is not None else None
+    if state is None:
+        try:
+            with open(fname) as f:
+                state = json.load(f, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return None
+        if _sync_states is not None:
+            _sync_states[fname] = state
+    if state.get("login") != acct["login"] or state.get("group") != group:
+        return None
+    if time.time() - state.get("full_sync", 0) > FULL_SYNC_INTERVAL:
+        return None
+    return state
+
+
+def save_sync_state(acct, group, state):
+    """Atomically write the sync state for a group."""
+    ensure_state_dir(SYNC_STATE_DIR)
+    state["login"] = acct["login"]
+    state["group"] = group
+    fname = sync_state_file(acct, group)
+    with open(fname + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.rename(fname + ".tmp", fname)
+    if _sync_states is not None:
+        _sync_states[fname] = state
+
+
+def keep_sync_states():
+    """Keep the sync states loaded or saved from now on in memory, rather than rereading them."""
+    global _sync_states
+    if _sync_states is None:
+        _sync_states = {}
+
+
+# sync states already loaded or saved in this run, keyed by file name, so that a long
+# running charrington (see Daemon) doesn't have to read them back every time. They hold
+# every contact's record, so a single sync doesn't keep them (this stays None).
+_sync_states = None
+
+
+def sync_group_contacts(gdc, acct, group, groups, page_size=PAGE_SIZE, previous=None):
+    """Return the contacts in a group, fetching only what changed since the last sync.
+
+    The result of the previous sync is loaded from the group's state file, and only
+    contacts updated since then (including deletions) are requested from Google and
+    merged into it. If there is no usable state, or Google can no longer tell us about
+    every deletion, the whole group is downloaded instead. Either way, the new state is
+    saved for next time, unless nothing changed at all.
+
+    previous can be the list this returned for the group last time (in this run); if
+    nothing has changed since, that same list is returned again.
+    """
+    # Google compares updated-min with its own clock, not ours, so the sync time is the
+    # first page's updated time; it's recorded before the rest of the feed is read, so
+    # that changes made while we're downloading will be picked up next time. Our own
+    # clock is only used if the feed doesn't say.
+    started = time.time()
+    since = None
+
+    state = load_sync_state(acct, group)
+    if state is not None:
+        known = state["contacts"]
+        changed = 0
+        try:
+            for entries, updated in iter_group_feed(gdc, group, groups, page_size, updated_min=state["updated"]):
+                since = since or updated
+                stats.count(group, "changed", len(entries))
+                changed += len(entries)
+                for entry in entries:
+                    # changed contacts replace their old record in place; deleted ones, ones
+                    # that no longer qualify, and ones that have left the group are dropped
+                    con = None
+                    if not entry.deleted and any(href == group and deleted != "true"
+                                                 for href, deleted in entry.memberships):
+                        con = entry.contact
+                    if con:
+                        known[con.id] = contact_to_record(con)
+                    else:
+                        known.pop(entry.id, None)
+            if previous is not None and not changed:
+                contacts = previous
+            else:
+                with stats.phase("contact parsing"):
+                    contacts = [contact_from_record(rec, groups) for rec in known.values()]
+            stats.count(group, "no email", sum(1 for con in contacts if not con.email))
+            if not changed:
+                # the saved state is still right as it is, so don't write it all out again
+                return contacts
+        except google().RequestError as e:
+            # 410 Gone means deleted contacts may have been missed since the last sync
+            if e.status != 410:
+                raise
+            state = None
+            since = None
+
+    if state is None:
+        contacts = []
+        for entries, updated in iter_group_feed(gdc, group, groups, page_size):
+            since = since or updated
+            contacts += page_contacts(group, entries)
+        state = {"full_sync": started,
+                 "contacts": OrderedDict((con.id, contact_to_record(con)) for con in contacts)}
+
+    state["updated"] = since or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started))
+    save_sync_state(acct, group, state)
+    return contacts
+
+
+def get_all_contacts(acct, groups, page_size=PAGE_SIZE):
+    """Take an account and a list of groups and return a list of contacts from matching groups."""
     contacts = []
     for group in acct["groups"]:
-        # set up a query for the contacts in the current group and fetch them
-        query = gdata.contacts.client.ContactsQuery()
-        query.max_results = 5000
-        query.group = group
-        feed = gdc.GetContacts(q=query)
-
-        for i, entry in enumerate(feed.entry):
-            # I chose to skip any items where there was no name entered.
-            if not entry.name:
-                continue
+        contacts += with_session(acct, lambda gdc: get_group_contacts(gdc, group, groups, page_size))
+    return contacts
 
-            # create a contact object by parsing the element data
-            con = make_contact(entry)
 
-            # now match the group id against the list of known groups from the server.
-            # if there's a match, add the group's name to the list of groups for the contact.
-            # skip the system groups entirely.
-            if entry.group_membership_info:
-                for cgroup in entry.group_membership_info:
-                    if cgroup.href in groups.keys() and not groups[cgroup.href].is_system:
-                        con.groups.append(groups[cgroup.href])
+def fetch_all(accts, workers, page_size=PAGE_SIZE, incremental=False, budget=None):
+    """Fetch the groups and contacts of every account using a pool of worker threads.
+
+    Nearly all of the time spent in a sync is waiting on the network, so the requests
+    are fanned out across accounts (for logins and group lists) and then across every
+    (account, group) pair (for the contact feeds). Results are collected in account and
+    group order, so the returned list is exactly what fetching them one at a time would
+    have produced.
+
+    If incremental is set, each group is brought up to date from its saved sync state
+    rather than downloaded in full (see sync_group_contacts).
+
+    Returns a tuple of (groups, contacts), where groups is the map of all groups across
+    all accounts and contacts is the list of contacts from the configured groups. If a
+    budget is given, contacts is a SortedRuns holding no more than that many contacts in
+    memory instead, with each (account, group) pair as one of its streams.
+    """
+    # multiprocessing is slow to import too, and only needed here (see GoogleBackend)
+    from multiprocessing.pool import ThreadPool
+
+    stats.add_accounts(accts)
+    pool = ThreadPool(max(1, workers))
+    runs = None
+    try:
+        # note that if you have groups with the same name in different accounts, they will be merged
+        # in the generated bbdb file
+        groups = {}
+        for acctgroups in pool.map(stats.profiled(get_all_contact_groups), accts):
+            groups.update(acctgroups)
+        if budget is not None:
+            runs = SortedRuns(groups, budget)
+
+        def fetch_group(task):
+            stream, (acct, group) = task
+            if runs is None:
+                if incremental:
+                    return with_session(acct, lambda gdc: sync_group_contacts(gdc, acct, group, groups, page_size))
+                return with_session(acct, lambda gdc: get_group_contacts(gdc, group, groups, page_size))
+
+            def fill(gdc):
+                # start over if with_session has to log in again halfway through
+                runs.clear(stream)
+                if incremental:
+                    contacts = sync_group_contacts(gdc, acct, group, groups, page_size)
+                else:
+                    contacts = iter_group_contacts(gdc, group, groups, page_size)
+                for con in contacts:
+                    runs.add(stream, con)
+            with_session(acct, fill)
+
+        tasks = list(enumerate((acct, group) for acct in accts for group in acct["groups"]))
+        results = pool.map(stats.profiled(fetch_group), tasks)
+    except:
+        if runs is not None:
+            runs.close()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    if runs is not None:
+        return groups, runs
+    contacts = []
+    for group_contacts in results:
+        contacts += group_contacts
+    return groups, contacts
 
-            # and finally add the new contact to the list
-            contacts.append(con)
-    return contacts
+
+class SortedRuns(object):
+    """The contacts of a sync, sorted by last name, with only a bounded number in memory.
+
+    Contacts are added in feed order to numbered streams, one for each (account, group)
+    pair. They're held in memory until there are more than budget of them across all the
+    streams, at which point the stream holding the most is sorted and written out to a
+    temporary file as a run. The runs of every stream (along with whatever is still held)
+    are then combined by a heap merge, which yields the contacts in exactly the order a
+    stable sort of the streams joined end to end would have, while reading each run from
+    disk a contact at a time.
+
+    Every run is an open file, so a small budget could otherwise run out of them; once
+    there are more than MAX_RUNS, half of them are merged into one (see combine).
+    """
+    def __init__(self, groups, budget=SORT_BUDGET):
+        self.groups = groups
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.held = {}
+        self.files = {}
+        self.sizes = {}
+        self.total_held = 0
+        self.total_runs = 0
+
+    def add(self, stream, con):
+        """Add a contact to the end of a stream, spilling a run to disk if over budget."""
+        with self.lock:
+            held = self.held.setdefault(stream, [])
+            size = self.sizes.get(stream, 0)
+            held.append((con.last_name.lower(), size, con))
+            self.sizes[stream] = size + 1
+            self.total_held += 1
+            if self.total_held > self.budget:
+                self.spill(max(self.held, key=lambda s: len(self.held[s])))
+
+    def spill(self, stream):
+        held = self.held.pop(stream)
+        with stats.phase("sort"):
+            held.sort(key=lambda item: item[0])
+            f = tempfile.TemporaryFile(prefix="charrington")
+            for key, seq, con in held:
+                f.write(json.dumps([key, seq, contact_to_record(con)]))
+                f.write("\n")
+        self.files.setdefault(stream, []).append(f)
+        self.total_held -= len(held)
+        self.total_runs += 1
+        stats.count("output", "contacts spilled to disk", len(held))
+        if self.total_runs > MAX_RUNS:
+            self.combine(max(self.files, key=lambda s: len(self.files[s])))
+
+    def combine(self, stream):
+        """Merge the newest runs of a stream into a single run.
+
+        The newest runs are the smallest, as older ones have usually been combined
+        already, so each contact is only written out again a few times however many
+        runs there are.
+        """
+        files = self.files[stream]
+        if len(files) < 2:
+            return
+        count = min(len(files), MAX_RUNS // 2)
+        with stats.phase("sort"):
+            f = tempfile.TemporaryFile(prefix="charrington")
+            # (key, seq) is unique within a stream, so the lines themselves are never compared
+            for key, seq, line in heapq.merge(*[self.read_lines(run) for run in files[-count:]]):
+                f.write(line)
+        for run in files[-count:]:
+            run.close()
+        files[-count:] = [f]
+        self.total_runs -= count - 1
+        stats.count("output", "sorted runs combined", count)
+
+    def clear(self, stream):
+        """Throw away everything added to a stream so far."""
+        with self.lock:
+            self.total_held -= len(self.held.pop(stream, []))
+            for f in self.files.pop(stream, []):
+                f.close()
+                self.total_runs -= 1
+            self.sizes.pop(stream, None)
+
+    def sort(self):
+        """Sort the contacts still held in memory; call this once everything is added."""
+        for held in self.held.values():
+            held.sort(key=lambda item: item[0])
+
+    def read_lines(self, f):
+        f.seek(0)
+        for line in f:
+            key, seq, rec = json.loads(line)
+            yield key, seq, line
+
+    def read_run(self, f):
+        f.seek(0)
+        for line in f:
+            key, seq, rec = json.loads(line)
+            yield key, seq, contact_from_record(rec, self.groups)
+
+    def merge(self):
+        """Yield (position, contact) pairs for every contact, in sorted order.
+
+        position is the contact's place in the streams joined end to end, i.e., its
+        index in the list fetch_all would otherwise have returned.
+        """
+        heap = []
+        offsets = {}
+        offset = 0
+        for stream in sorted(self.sizes):
+            offsets[stream] = offset
+            offset += self.sizes[stream]
+            runs = [self.read_run(f) for f in self.files.get(stream, [])] + [iter(self.held.get(stream, []))]
+            for run in runs:
+                for key, seq, con in run:
+                    heap.append((key, stream, seq, con, run))
+                    break
+        # (key, stream, seq) is unique, so the contacts themselves are never compared
+        heapq.heapify(heap)
+        while heap:
+            key, stream, seq, con, run = heap[0]
+            yield offsets[stream] + seq, con
+            for key, seq, con in run:
+                heapq.heapreplace(heap, (key, stream, seq, con, run))
+                break
+            else:
+                heapq.heappop(heap)
+
+    def contacts(self):
+        """Yield every contact, in sorted order (see merge)."""
+        for position, con in self.merge():
+            yield con
+
+    def close(self):
+        """Delete the runs spilled to disk."""
+        for files in self.files.values():
+            for f in files:
+                f.close()
+        self.files = {}
+        self.total_runs = 0
+
+
+def normalize_email(address):
+    """Return an email address in the form used to recognize duplicates."""
+    return address.strip().lower()
+
+
+def normalize_phone(number):
+    """Return a phone number in the form used to recognize duplicates, or None.
+
+    Only the digits are kept, and of those only the last ten, so that the same number
+    written with and without a country code still matches. Numbers with fewer than
+    seven digits are too ambiguous to match on, and give None.
+    """
+    digits = "".join(c for c in number if c.isdigit())
+    if len(digits) < 7:
+        return None
+    return digits[-10:]
+
+
+def copy_contact(con):
+    """Return a copy of a contact that can be changed without affecting the original."""
+    copy = Contact()
+    for name in Contact.__slots__:
+        value = getattr(con, name)
+        setattr(copy, name, list(value) if isinstance(value, list) else value)
+    return copy
+
+
+def merge_duplicates(contacts):
+    """Merge contacts that appear to be the same person, and return the merged list.
+
+    Contacts from different accounts are considered the same person if they share a
+    google id, an email address, or a phone number (after normalization), either
+    directly or through a chain of other contacts. Two contacts from the same account
+    are never merged, though: they have different google ids, so they're different
+    people who happen to share something (a household's phone, an office switchboard),
+    and a set of duplicates never holds more than one contact from each account. To
+    keep this linear in the number of contacts, nobody is ever compared with anybody
+    else; instead each normalized address and number is looked up in a hash index, and
+    contacts sharing one are joined with a union-find structure.
+
+    Each set of duplicates becomes a single record in the position of the first of them.
+    That record keeps the first contact's name and google id, fills in a missing
+    organization, gains every distinct phone number, postal address, email address and
+    group of the others, and takes the most recent of their timestamps. The contacts
+    passed in are left as they were; merged records are copies.
+    """
+    # collapse repeated google ids first; those are the same contact fetched from several groups
+    unique = []
+    by_id = {}
+    for con in contacts:
+        if con.id not in by_id:
+            by_id[con.id] = len(unique)
+            unique.append(con)
+
+    parent = range(len(unique))
+    # the accounts in each set, kept for its root; contacts whose id doesn't say which
+    # account they're from count as an account of their own
+    logins = [set([contact_login(con) or con.id]) for con in unique]
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i == j or logins[i] & logins[j]:
+            return
+        # the earliest contact is always the root of its set
+        if j < i:
+            i, j = j, i
+        parent[j] = i
+        logins[i] |= logins[j]
+        logins[j] = None
+
+    emails = {}
+    phones = {}
+    for i, con in enumerate(unique):
+        for email in con.email:
+            union(i, emails.setdefault(normalize_email(email[EMAIL_ADDRESS]), i))
+        for phone in con.phone_numbers:
+            number = normalize_phone(phone[PHONE_NUMBER] or "")
+            if number:
+                union(i, phones.setdefault(number, i))
+
+    merged = []
+    position = {}
+    # what each copied root already has, so merging another contact in is linear in its size
+    known = {}
+    for i, con in enumerate(unique):
+        root = find(i)
+        if root == i:
+            position[i] = len(merged)
+            merged.append(con)
+            continue
+        if root not in known:
+            into = unique[root] = merged[position[root]] = copy_contact(unique[root])
+            known[root] = (set(normalize_phone(p[PHONE_NUMBER] or "") or p[PHONE_NUMBER] for p in into.phone_numbers),
+                           set(normalize_email(e[EMAIL_ADDRESS]) for e in into.email),
+                           set(into.addresses),
+                           set(group.href for group in into.groups))
+        into = unique[root]
+        known_phones, known_emails, known_addresses, known_groups = known[root]
+        if not into.organization:
+            into.organization = con.organization
+        for phone in con.phone_numbers:
+            number = normalize_phone(phone[PHONE_NUMBER] or "") or phone[PHONE_NUMBER]
+            if number not in known_phones:
+                known_phones.add(number)
+                into.phone_numbers.append(phone)
+        for addr in con.addresses:
+            if addr not in known_addresses:
+                known_addresses.add(addr)
+                into.addresses.append(addr)
+        for email in con.email:
+            address = normalize_email(email[EMAIL_ADDRESS])
+            if address not in known_emails:
+                known_emails.add(address)
+                into.email.append(email)
+        for group in con.groups:
+            if group.href not in known_groups:
+                known_groups.add(group.href)
+                into.groups.append(group)
+        into.timestamp = max(into.timestamp, con.timestamp)
+    return merged
+
+
+def open_store():
+    """Open (creating it if necessary) the local SQLite store of synced contacts."""
+    ensure_state_dir()
+    db = sqlite3.connect(STORE_FILE)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS groups (href TEXT PRIMARY KEY, name TEXT, is_system INTEGER);
+        CREATE TABLE IF NOT EXISTS contacts (google_id TEXT PRIMARY KEY, position INTEGER, data TEXT);
+        CREATE TABLE IF NOT EXISTS memberships (google_id TEXT, href TEXT);
+        CREATE INDEX IF NOT EXISTS contacts_position ON contacts (position);
+        CREATE INDEX IF NOT EXISTS memberships_href ON memberships (href);
+        CREATE TABLE IF NOT EXISTS query_entries (id INTEGER PRIMARY KEY, email TEXT, name TEXT, info TEXT,
+                                                  haystack TEXT);
+        CREATE TABLE IF NOT EXISTS query_terms (term TEXT, entry INTEGER);
+        CREATE INDEX IF NOT EXISTS query_terms_term ON query_terms (term);
+    """)
+    return db
+
+
+def save_store(groups, contacts):
+    """Replace the contents of the local store with the results of a sync.
+
+    Contacts are keyed by google id. Since a contact appears once for every configured
+    group it is in, only its first appearance is kept, along with its position in the
+    list, which is all that is needed to regenerate exactly the same output later.
+    contacts can also be a SortedRuns, in which case they're saved as they come out of
+    the merge, with their positions in the list they would otherwise have been.
+    """
+    with stats.phase("local store"):
+        if isinstance(contacts, SortedRuns):
+            _save_store(groups, contacts.merge())
+        else:
+            _save_store(groups, enumerate(contacts))
+
+
+def _save_store(groups, numbered):
+    db = open_store()
+    try:
+        with db:
+            db.execute("DELETE FROM groups")
+            db.execute("DELETE FROM contacts")
+            db.execute("DELETE FROM memberships")
+            db.execute("DELETE FROM query_entries")
+            db.execute("DELETE FROM query_terms")
+            db.executemany("INSERT INTO groups VALUES (?, ?, ?)",
+                           [(g.href, g.name, g.is_system) for g in groups.values()])
+            for position, con in numbered:
+                rec = contact_to_record(con)
+                cursor = db.execute("INSERT OR IGNORE INTO contacts VALUES (?, ?, ?)",
+                                    (con.id, position, json.dumps(rec)))
+                if cursor.rowcount:
+                    db.executemany("INSERT INTO memberships VALUES (?, ?)", [(con.id, href) for href in rec["groups"]])
+                    if con.email:
+                        index_contact(db, position, con)
+    finally:
+        db.close()
+
+
+def load_store():
+    """Return the (groups, contacts) saved by the last sync, or None if nothing has been saved."""
+    if not os.path.exists(STORE_FILE):
+        return None
+    db = open_store()
+    try:
+        groups = {}
+        for href, name, is_system in db.execute("SELECT href, name, is_system FROM groups"):
+            cg = ContactGroup()
+            cg.href = href
+            cg.name = name
+            cg.is_system = bool(is_system)
+            groups[cg.href] = cg
+        contacts = [contact_from_record(json.loads(data), groups)
+                    for (data,) in db.execute("SELECT data FROM contacts ORDER BY position")]
+    finally:
+        db.close()
+    return groups, contacts
+
+
+def index_contact(db, position, contact):
+    """Add a contact to the index used to answer address queries (see query_contacts).
+
+    There is one entry for each email address of each contact that would be written
+    to a mutt aliases file. Every entry is indexed under the lowercased words of the
+    contact's name, the full name, the address and its local part, and the contact's
+    group aliases, which is what prefix lookups search. Substring lookups search a
+    lowercased string holding all of the above.
+
+    Entries are numbered by the contact's position (and the address's place among its
+    emails), so lookups list them in that order whatever order they were added in.
+    """
+    name = u" ".join(x.strip() for x in (contact.first_name, contact.last_name) if x.strip())
+    aliases = [group.alias for group in contact.groups]
+    info = u", ".join(aliases) or contact.organization
+    for n, email in enumerate(contact.email):
+        address = email[EMAIL_ADDRESS]
+        terms = set(name.lower().split() + [name.lower(), address.lower(), address.split("@")[0].lower()] + aliases)
+        terms.discard(u"")
+        entry = (position << 16) + n
+        db.execute("INSERT INTO query_entries VALUES (?, ?, ?, ?, ?)",
+                   (entry, address, name, info, u" ".join([name, address] + aliases).lower()))
+        db.executemany("INSERT INTO query_terms VALUES (?, ?)", [(term, entry) for term in terms])
+
+
+def query_contacts(text):
+    """Return a list of (email, name, info) tuples for the indexed contacts matching text.
+
+    Entries with a name, address, or group alias that starts with text come first,
+    followed by those that merely contain it somewhere. Matching is case insensitive.
+    Returns None if there is no index yet.
+    """
+    if not os.path.exists(STORE_FILE):
+        return None
+    text = text.decode("utf-8").lower() if isinstance(text, str) else text.lower()
+    db = sqlite3.connect(STORE_FILE)
+    try:
+        prefix = db.execute("""SELECT DISTINCT e.id, e.email, e.name, e.info FROM query_terms t
+                               JOIN query_entries e ON e.id = t.entry
+                               WHERE t.term >= ? AND t.term < ? ORDER BY e.id""",
+                            (text, text + u"\uffff")).fetchall()
+        pattern = u"%" + text.replace(u"\\", u"\\\\").replace(u"%", u"\\%").replace(u"_", u"\\_") + u"%"
+        substring = db.execute("""SELECT id, email, name, info FROM query_entries
+                                  WHERE haystack LIKE ? ESCAPE '\\' ORDER BY id""", (pattern,)).fetchall()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        db.close()
+    found = set(row[0] for row in prefix)
+    return [row[1:] for row in prefix] + [row[1:] for row in substring if row[0] not in found]
 
 
 def make_contact(entry):
-    """Given a contact entry in GData format, create a Contact object."""
+    """Given a contact entry (an ElementTree element from a contacts feed), create a Contact object."""
     con = Contact()
     # names are handled a bit weirdly here. BBDB doesn't really support
     # any rich representation of names -- it's pretty much First/Last. So
     # if a contact has "Additional Names" in Google's schema, I arbitrarily
     # chose to append them to the first name field
-    if entry.name:
-        con.first_name = safe_text(entry.name.given_name)
-        con.last_name = safe_text(entry.name.family_name)
-        if entry.name.additional_name:
-            con.first_name += " " + entry.name.additional_name.text
-    if entry.nickname:
-        con.nickname = [entry.nickname]
-    if entry.organization and entry.organization.name:
-        con.organization = entry.organization.name.text
-    for ph_entry in entry.phone_number:
+    name = entry.find(GD + "name")
+    if name is not None:
+        con.first_name = safe_text(name.find(GD + "givenName"))
+        con.last_name = safe_text(name.find(GD + "familyName"))
+        additional_name = name.find(GD + "additionalName")
+        if additional_name is not None:
+            con.first_name += " " + additional_name.text
+    nickname = entry.find(GCONTACT + "nickname")
+    if nickname is not None:
+        con.nickname = [nickname.text]
+    organization = entry.find(GD + "organization")
+    if organization is not None and organization.find(GD + "orgName") is not None:
+        con.organization = organization.findtext(GD + "orgName") or None
+    for ph_entry in entry.iterfind(GD + "phoneNumber"):
         con.phone_numbers.append(parse_phone(ph_entry))
-    for addr_entry in entry.structured_postal_address:
+    for addr_entry in entry.iterfind(GD + "structuredPostalAddress"):
         con.addresses.append(parse_address(addr_entry))
-    for email in entry.email:
+    for email in entry.iterfind(GD + "email"):
         con.email.append(parse_email(email))
 
-    con.timestamp = canonicalize_date(safe_text(entry.updated))
-    con.id = entry.id.text
+    con.timestamp = intern_string(canonicalize_date(safe_text(entry.find(ATOM + "updated"))))
+    con.id = entry.findtext(ATOM + "id")
     return con
 
 
@@ -244,19 +1736,29 @@ def get_label_from_schema(entry):
     characters.
 
     This function grabs that last bit of the string, title-cases it, and returns
-    it as a label.
+    it as a label. There are only a handful of distinct labels, so each one is worked
+    out once and the same string is handed back for every field that uses it.
     """
-    if entry.rel:
-        if "label=" in entry.rel:
-            return entry.rel.rsplit("label=", 1)[1].title()
-        else:
-            return entry.rel.rsplit("#", 1)[1].title()
+    rel = entry.get("rel")
+    if rel:
+        label = _labels.get(rel)
+        if label is None:
+            if "label=" in rel:
+                label = rel.rsplit("label=", 1)[1].title()
+            else:
+                label = rel.rsplit("#", 1)[1].title()
+            label = _labels.setdefault(rel, intern_string(label))
+        return label
+
+
+# labels already extracted by get_label_from_schema, keyed by schema URI
+_labels = {}
 
 
 def parse_phone(phone_entry):
-    """Parse an instance of a gdata.data.PhoneNumber and return the label and number.
+    """Parse a gd:phoneNumber element and return the label and number.
 
-    Note that the gdata class is very cumbersome, as it is completely unstructured;
+    Note that the phone number is very cumbersome, as it is completely unstructured;
     you only have XML fragments. The number is simply the text of the XML node, which
     is easy enough to get, but the label appears to only be present as a part of a
     schema URL embedded in the "rel" attribute.
@@ -277,44 +1779,45 @@ def parse_address(addr_entry):
     If both are present, write the neighborhood as line two of the street address.
     """
     label = get_label_from_schema(addr_entry)
-    if addr_entry.po_box:
-        street = safe_text(addr_entry.po_box)
+    po_box = addr_entry.find(GD + "pobox")
+    if po_box is not None:
+        street = safe_text(po_box)
     else:
-        street = safe_text(addr_entry.street)
+        street = safe_text(addr_entry.find(GD + "street"))
 
     # figure out neighborhood/city distinction.
     neighborhood = None
-    if addr_entry.neighborhood:
-        if not addr_entry.city:
-            city = addr_entry.neighborhood.text
+    city = addr_entry.find(GD + "city")
+    if addr_entry.find(GD + "neighborhood") is not None:
+        if city is None:
+            city = addr_entry.find(GD + "neighborhood").text
         else:
-            neighborhood = addr_entry.neighborhood.text
-            city = addr_entry.city.text
+            neighborhood = addr_entry.find(GD + "neighborhood").text
+            city = city.text
     else:
-        city = safe_text(addr_entry.city)
+        city = safe_text(city)
 
-    region = safe_text(addr_entry.region)
-    postcode = safe_text(addr_entry.postcode)
-    country = safe_text(addr_entry.country)
+    region = safe_text(addr_entry.find(GD + "region"))
+    postcode = safe_text(addr_entry.find(GD + "postcode"))
+    country = safe_text(addr_entry.find(GD + "country"))
     return (label, street, neighborhood, city, region, postcode, country)
 
 
 def parse_email(email_entry):
-    """Parse gdata Email entry and return the label, address, and primary flag."""
+    """Parse a gd:email element and return the label, address, and primary flag."""
     label = get_label_from_schema(email_entry)
-    return (label, email_entry.address, email_entry.primary)
+    return (label, email_entry.get("address"), intern_string(email_entry.get("primary")))
 
 
 def safe_text(entry):
-    """Does a null check on the field and returns a representative string.
+    """Does a null check on an element and returns a representative string.
 
-    In the Google APIs, most things are classes. So if you call address.city, you
-    get back a structure rather than a string. Calling address.city.text works, but
-    needs to be protected by a null check. This function simply takes one of these
-    structures, checks to see if it's None, and returns either "" or its text
-    attribute accordingly.
+    Most fields are child elements, so the element has to be found and its text
+    taken, with a check for the element not being there. This function simply takes
+    one of these elements (or None), and returns either "" or its text (with any line
+    breaks turned into commas) accordingly.
     """
-    if not entry:
+    if entry is None:
         return ""
     else:
         return ", ".join(entry.text.split("\n"))
@@ -334,8 +1837,15 @@ def canonicalize_date(ts):
         return ts
 
 
+# unicode.translate takes a single map, so build the equivalent of the str.translate arguments
+_GROUP_NAME_TABLE = dict((ord(c), None) for c in string.punctuation)
+_GROUP_NAME_TABLE.update((ord(u), ord(l)) for u, l in zip("ABCDEFGHIJKLMNOPQRSTUVWXYZ ", "abcdefghijklmnopqrstuvwxyz_"))
+
+
 def canonicalize_group_name(gname):
     """Return a lowercased version of a group name without special characters."""
+    if isinstance(gname, unicode):
+        return gname.translate(_GROUP_NAME_TABLE)
     return gname.translate(string.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ ",
                                             "abcdefghijklmnopqrstuvwxyz_"),
                            string.punctuation)
@@ -374,93 +1884,336 @@ def format_contact_bbdb(contact):
     See http://bbdb.sourceforge.net/bbdb.html#SEC67 for more information on the format.
     """
     # write first name, last name, and company -- ignore any nicknames
-    str = u"[\"{fn}\" \"{ln}\" nil \"{co}\"".format(fn=contact.first_name,
-                                                    ln=contact.last_name,
-                                                    co=contact.organization)
+    parts = [u"[\"{fn}\" \"{ln}\" nil \"{co}\"".format(fn=contact.first_name,
+                                                       ln=contact.last_name,
+                                                       co=contact.organization)]
 
     # write the list of phone numbers
     if len(contact.phone_numbers) == 0:
-        str += u" nil"
+        parts.append(u" nil")
     else:
-        str += u" ("
-        first_pass = True
-        for phone in contact.phone_numbers:
-            if not first_pass:
-                str += u" "
-            str += u"[\"{lb}\" \"{num}\"]".format(lb=phone[PHONE_LABEL],
-                                                  num=phone[PHONE_NUMBER])
-            first_pass = False
-        str += u")"
+        parts.append(u" (")
+        parts.append(u" ".join([u"[\"{lb}\" \"{num}\"]".format(lb=phone[PHONE_LABEL], num=phone[PHONE_NUMBER])
+                                for phone in contact.phone_numbers]))
+        parts.append(u")")
 
     # write the list of postal addresses
     if len(contact.addresses) == 0:
-        str += u" nil"
+        parts.append(u" nil")
     else:
-        str += u" ("
-        first_pass = True
+        addrs = []
         for addr in contact.addresses:
-            if not first_pass:
-                str += u" "
             if addr[ADDR_NEIGHBORHOOD]:
-                str += u"[\"{lb}\" (\"{st}\" \"{nb}\") \"{ci}\" \"{rg}\" \"{pc}\" \"{co}\"]"\
-                       .format(lb=addr[ADDR_LABEL], st=addr[ADDR_STREET], nb=addr[ADDR_NEIGHBORHOOD],
-                               ci=addr[ADDR_CITY], rg=addr[ADDR_STATE], pc=addr[ADDR_ZIP], co=addr[ADDR_COUNTRY])
+                addrs.append(u"[\"{lb}\" (\"{st}\" \"{nb}\") \"{ci}\" \"{rg}\" \"{pc}\" \"{co}\"]"
+                             .format(lb=addr[ADDR_LABEL], st=addr[ADDR_STREET], nb=addr[ADDR_NEIGHBORHOOD],
+                                     ci=addr[ADDR_CITY], rg=addr[ADDR_STATE], pc=addr[ADDR_ZIP], co=addr[ADDR_COUNTRY]))
             else:
-                str += u"[\"{lb}\" (\"{st}\") \"{ci}\" \"{rg}\" \"{pc}\" \"{co}\"]"\
-                       .format(lb=addr[ADDR_LABEL], st=addr[ADDR_STREET], ci=addr[ADDR_CITY], rg=addr[ADDR_STATE],
-                               pc=addr[ADDR_ZIP], co=addr[ADDR_COUNTRY])
-            first_pass = False
-        str += u")"
+                addrs.append(u"[\"{lb}\" (\"{st}\") \"{ci}\" \"{rg}\" \"{pc}\" \"{co}\"]"
+                             .format(lb=addr[ADDR_LABEL], st=addr[ADDR_STREET], ci=addr[ADDR_CITY], rg=addr[ADDR_STATE],
+                                     pc=addr[ADDR_ZIP], co=addr[ADDR_COUNTRY]))
+        parts.append(u" (")
+        parts.append(u" ".join(addrs))
+        parts.append(u")")
 
     # write out the email addresses
     if len(contact.email) == 0:
-        str += u" nil"
+        parts.append(u" nil")
     else:
-        str += u" ("
-        first_pass = True
-        for email in contact.email:
-            if not first_pass:
-                str += u" "
-            str += u"\"{em}\"".format(em=email[EMAIL_ADDRESS])
-            first_pass = False
-        str += u")"
+        parts.append(u" (")
+        parts.append(u" ".join([u"\"{em}\"".format(em=email[EMAIL_ADDRESS]) for email in contact.email]))
+        parts.append(u")")
 
     # Notes field contains an alist of assorted data; for now, I'm just storing
     # the modification date (YYYY-MM-DD)
-    str += u" ("
-    str += u"(timestamp . \"{ts}\")".format(ts=contact.timestamp)
-    str += u" (google-id . \"{id}\")".format(id=contact.id)
+    parts.append(u" (")
+    parts.append(u"(timestamp . \"{ts}\")".format(ts=contact.timestamp))
+    parts.append(u" (google-id . \"{id}\")".format(id=contact.id))
     if len(contact.groups) > 0:
-        str += u" (mail-alias . \"{alias}\")".format(alias=', '.join([canonicalize_group_name(x.name) for x in contact.groups]))
-    str += u")"
+        parts.append(u" (mail-alias . \"{alias}\")".format(alias=', '.join([x.alias for x in contact.groups])))
+    parts.append(u")")
 
     # there appears to be an additional "nil" at the end...no idea what it's for
-    str += u" nil"
+    parts.append(u" nil")
 
     # close the opening bracket
-    str += u"]"
-    return str
+    parts.append(u"]")
+    return u"".join(parts)
 
 
-def print_bbdb_header():
-    """Print the required BBDB header information."""
-    print(";; -*-coding: utf-8-emacs;-*-")
-    print(";;; file-version: 6")
+class OutputSink(object):
+    """A destination for generated output: either stdout or a file that is replaced atomically.
 
+    Text written to the sink is encoded to UTF-8 and collected in a large buffer that is
+    flushed in big chunks rather than one record at a time. When writing to a file, the
+    output goes to a temporary file in the same directory that is renamed over the
+    target when the sink is closed. If the new content is identical to what the file
+    already holds, the temporary file is discarded instead, so the target (and anything
+    watching it) is left untouched.
 
-def output_bbdb_file(contacts):
-    """Print all contact records as a BBDB file."""
-    print_bbdb_header()
-    printed = set()
-    for contact in contacts:
-        # don't print the same contact twice
-        if contact.id in printed:
-            continue
-        # don't print entries that have no email addresses
-        if not contact.email:
-            continue
-        print(format_contact_bbdb(contact).encode("utf-8"))
-        printed.add(contact.id)
+    Sinks are context managers; if the with block raises, the partial output is thrown
+    away and the target file is not modified.
+    """
+    def __init__(self, path=None, bufsize=OUTPUT_BUFFER_SIZE):
+        self.path = path
+        self.bufsize = bufsize
+        self.chunks = []
+        self.buffered = 0
+        self.digest = hashlib.sha1()
+        if path:
+            # write the file a symlink points to (say, ~/.bbdb in a dotfiles repository)
+            # rather than replacing the link itself
+            self.path = os.path.realpath(path)
+            fd, self.tmpname = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                                prefix="." + os.path.basename(self.path))
+            self.out = os.fdopen(fd, "wb")
+        else:
+            self.out = sys.stdout
+
+    def write(self, text):
+        """Write a unicode string (which is encoded as UTF-8) or a byte string."""
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self.digest.update(text)
+        self.chunks.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        with stats.phase("write"):
+            self.out.write("".join(self.chunks))
+        stats.count("output", "bytes written", self.buffered)
+        self.chunks = []
+        self.buffered = 0
+
+    def close(self):
+        """Finish writing, and return True if the output was actually written."""
+        with stats.phase("write"):
+            try:
+                return self._close()
+            except:
+                # don't leave the temporary file behind (a full disk would only get fuller)
+                self.abort()
+                raise
+
+    def _close(self):
+        self.flush()
+        if not self.path:
+            self.out.flush()
+            return True
+        self.out.close()
+        if os.path.exists(self.path):
+            if file_digest(self.path) == self.digest.digest():
+                os.remove(self.tmpname)
+                stats.count("output", "unchanged, not replaced")
+                return False
+            shutil.copymode(self.path, self.tmpname)
+        else:
+            # mkstemp creates files readable only by the user; use the usual permissions instead
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.tmpname, 0o666 & ~umask)
+        os.rename(self.tmpname, self.path)
+        return True
+
+    def abort(self):
+        """Throw away everything written to the sink."""
+        if self.path:
+            self.out.close()
+            if os.path.exists(self.tmpname):
+                os.remove(self.tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def file_digest(fname):
+    """Return the SHA-1 digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(OUTPUT_BUFFER_SIZE), ""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def write_bbdb_header(out):
+    """Write the required BBDB header information."""
+    out.write(";; -*-coding: utf-8-emacs;-*-\n")
+    out.write(";;; file-version: 6\n")
+
+
+class BBDBWriter(object):
+    """Writes contacts to an OutputSink as a BBDB file.
+
+    Writers are handed the contacts by write_contacts: start is called first, then
+    write once for every contact that should be written (in order, without duplicates
+    or contacts lacking an email address), and finish at the end. New output formats
+    only need a writer class like this one and an entry in WRITERS.
+    """
+    def __init__(self, out, jobs=1):
+        self.out = out
+        self.jobs = jobs
+        self.pending = []
+
+    def start(self):
+        write_bbdb_header(self.out)
+
+    def write(self, contact):
+        if self.jobs > 1:
+            # formatted all at once by a pool of processes when finished
+            self.pending.append(contact)
+        else:
+            self.out.write(format_contact_bbdb(contact))
+            self.out.write("\n")
+
+    def finish(self):
+        if self.pending:
+            for chunk in format_bbdb_parallel(self.pending, self.jobs):
+                self.out.write(chunk)
+            self.pending = []
+
+
+def output_bbdb_file(contacts, out, jobs=1):
+    """Write all contact records as a BBDB file to an OutputSink."""
+    write_contacts(contacts, [BBDBWriter(out, jobs)])
+
+
+def format_bbdb_parallel(contacts, jobs):
+    """Yield the BBDB records for contacts as UTF-8 chunks, formatted by jobs processes.
+
+    The contacts are split into runs of FORMAT_CHUNK_SIZE, each formatted and encoded
+    by a worker process, and the chunks are yielded in order, so joining them gives
+    exactly the bytes formatting them one at a time would have. The workers are forked
+    from this process and find the contacts already in their memory, so only the
+    bounds of each run and the finished chunks pass between processes. Lists too short
+    to be worth starting the workers for are formatted here.
+    """
+    global _format_contacts
+    if len(contacts) < 2 * FORMAT_CHUNK_SIZE or jobs < 2:
+        _format_contacts = contacts
+        try:
+            yield format_bbdb_chunk((0, len(contacts)))
+        finally:
+            _format_contacts = None
+        return
+
+    # like the thread pool, only imported when it's needed (see GoogleBackend)
+    from multiprocessing import Pool
+
+    _format_contacts = contacts
+    pool = Pool(jobs)
+    try:
+        bounds = [(start, min(start + FORMAT_CHUNK_SIZE, len(contacts)))
+                  for start in xrange(0, len(contacts), FORMAT_CHUNK_SIZE)]
+        for chunk in pool.imap(format_bbdb_chunk, bounds):
+            yield chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _format_contacts = None
+
+
+def format_bbdb_chunk(bounds):
+    """Format the contacts from start to stop in _format_contacts as UTF-8 BBDB records."""
+    start, stop = bounds
+    return u"".join(format_contact_bbdb(contact) + u"\n" for contact in _format_contacts[start:stop]).encode("utf-8")
+
+
+# the contacts format_bbdb_parallel is working on, where its workers can find them
+_format_contacts = None
+
+
+# notes entries that charrington writes into every BBDB record
+BBDB_GOOGLE_ID = re.compile(r'\(google-id \. "([^"]*)"\)')
+BBDB_TIMESTAMP = re.compile(r'\(timestamp \. "([^"]*)"\)')
+
+
+class BBDBMergeWriter(object):
+    """Merges contacts into an existing BBDB file, rewriting only what changed.
+
+    The contacts are collected as they're written, and the existing file is then read
+    a line (record) at a time, with each record matched to the synced contacts through
+    the google-id in its notes. Records whose timestamp hasn't changed are copied
+    through byte for byte, changed records are replaced, records for contacts that are
+    no longer synced are dropped, and records without a google-id (ones you created
+    locally) are left alone. Contacts that aren't in the file yet are appended at the
+    end. The new file replaces the old one atomically.
+
+    BBDB timestamps only have day resolution, so a record stamped on or after the day
+    the file was last written is always regenerated, in case it changed again later
+    that day.
+
+    Once finished, the writer's counts are a tuple (kept, replaced, added, dropped) of
+    record counts.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.wanted = OrderedDict()
+        self.counts = None
+
+    def start(self):
+        pass
+
+    def write(self, contact):
+        self.wanted[contact.id] = contact
+
+    def finish(self):
+        wanted = self.wanted
+        try:
+            existing = open(self.fname, "rb")
+            cutoff = time.strftime("%Y-%m-%d", time.gmtime(os.fstat(existing.fileno()).st_mtime))
+        except IOError:
+            existing = None
+
+        kept = replaced = dropped = 0
+        with OutputSink(self.fname) as out:
+            if existing is None:
+                write_bbdb_header(out)
+            else:
+                with existing:
+                    for line in existing:
+                        if not line.endswith("\n"):
+                            line += "\n"
+                        match = BBDB_GOOGLE_ID.search(line)
+                        if line.startswith(";") or not match:
+                            out.write(line)
+                            continue
+                        contact = wanted.pop(match.group(1), None)
+                        if contact is None:
+                            # deleted from Google, no longer synced, or a duplicate record
+                            dropped += 1
+                            continue
+                        stamp = BBDB_TIMESTAMP.search(line)
+                        if stamp and stamp.group(1) == contact.timestamp and contact.timestamp < cutoff:
+                            out.write(line)
+                            kept += 1
+                        else:
+                            out.write(format_contact_bbdb(contact))
+                            out.write("\n")
+                            replaced += 1
+            for contact in wanted.values():
+                out.write(format_contact_bbdb(contact))
+                out.write("\n")
+        self.counts = (kept, replaced, len(wanted), dropped)
+        for name, n in zip(("records kept", "records replaced", "records added", "records dropped"), self.counts):
+            stats.count("output", name, n)
+
+
+def merge_bbdb_file(fname, contacts):
+    """Merge contact records into an existing BBDB file (see BBDBMergeWriter).
+
+    Returns a tuple (kept, replaced, added, dropped) of record counts.
+    """
+    writer = BBDBMergeWriter(fname)
+    write_contacts(contacts, [writer])
+    return writer.counts
 
 
 def format_contact_mutt(nickname, first_name, last_name, addr):
@@ -470,23 +2223,22 @@ def format_contact_mutt(nickname, first_name, last_name, addr):
     are treated as groups). So this function writes an alias for a single given
     nickname, first and last name, and address.
     """
-    str = u"alias {nick} {first} {last} <{email}>".format(
+    return u"alias {nick} {first} {last} <{email}>".format(
         nick=nickname, first=first_name, last=last_name, email=addr)
-    return str
 
 
-def output_mutt_aliases(contacts):
-    """Print all contact records as a Mutt aliases file."""
-    nicks = {}
-    printed = set()
-    for contact in contacts:
-        # don't print the same contact twice
-        if contact.id in printed:
-            continue
-        # don't print entries that have no email addresses
-        if not contact.email:
-            continue
-        # now iterate over each address, and create a unique alias
+class MuttWriter(object):
+    """Writes contacts to an OutputSink as a Mutt aliases file (see BBDBWriter)."""
+    def __init__(self, out):
+        self.out = out
+        self.nicks = {}
+
+    def start(self):
+        pass
+
+    def write(self, contact):
+        # iterate over each address, and create a unique alias
+        nicks = self.nicks
         for email in contact.email:
             fname = contact.first_name.lower().replace(" ", "")
             nick = fname
@@ -495,15 +2247,90 @@ def output_mutt_aliases(contacts):
                 nicks[fname] += 1
             else:
                 nicks[fname] = 1
-            print(format_contact_mutt(nick, contact.first_name, contact.last_name, email[EMAIL_ADDRESS]).encode("utf-8"))
+            self.out.write(format_contact_mutt(nick, contact.first_name, contact.last_name, email[EMAIL_ADDRESS]))
+            self.out.write("\n")
+
+    def finish(self):
+        pass
+
+
+def output_mutt_aliases(contacts, out):
+    """Write all contact records as a Mutt aliases file to an OutputSink."""
+    write_contacts(contacts, [MuttWriter(out)])
+
+
+# the output formats, and the writer classes that produce them
+WRITERS = OrderedDict([("bbdb", BBDBWriter),
+                       ("mutt", MuttWriter)])
+
+
+def write_contacts(contacts, writers):
+    """Hand the contacts to every writer in a single pass over them.
+
+    This is where the contacts to write are picked: the same contact is never written
+    twice, and contacts without an email address aren't written at all. Returns the
+    number of contacts written.
+    """
+    for writer in writers:
+        writer.start()
+    printed = set()
+    for contact in contacts:
+        # don't print the same contact twice
+        if contact.id in printed:
+            stats.count(contact_login(contact), "duplicates dropped")
+            continue
+        # don't print entries that have no email addresses
+        if not contact.email:
+            continue
         printed.add(contact.id)
+        for writer in writers:
+            writer.write(contact)
+    for writer in writers:
+        writer.finish()
+    stats.count("output", "records written", len(printed))
+    return len(printed)
+
+
+def write_outputs(contacts, targets, jobs=1):
+    """Write the contacts to every output target in a single pass.
+
+    targets is a list of (format, path) pairs, where format is one of WRITERS or
+    "merge" (to merge into an existing BBDB file), and a path of None means stdout.
+    With jobs greater than one, BBDB records are formatted by that many processes.
+    If anything goes wrong while writing, the partial outputs are thrown away and the
+    files they were meant for are left as they were. Returns the number of contacts
+    written (see write_contacts).
+    """
+    sinks = []
+    writers = []
+    try:
+        for fmt, path in targets:
+            if fmt == "merge":
+                writers.append(BBDBMergeWriter(path))
+            else:
+                sinks.append(OutputSink(path))
+                if fmt == "bbdb":
+                    writers.append(BBDBWriter(sinks[-1], jobs))
+                else:
+                    writers.append(WRITERS[fmt](sinks[-1]))
+        written = write_contacts(contacts, writers)
+    except:
+        for sink in sinks:
+            sink.abort()
+        raise
+    for n, sink in enumerate(sinks):
+        try:
+            sink.close()
+        except:
+            for other in sinks[n + 1:]:
+                other.abort()
+            raise
+    return written
 
 
 def display_groups(acct):
     """Print information about all contact groups in the given account."""
-    gdc = gdata.contacts.client.ContactsClient(source='charrington')
-    gdc.ClientLogin(acct["login"], acct["password"], gdc.source)
-    feed = gdc.GetGroups()
+    feed = with_session(acct, lambda gdc: gdc.GetGroups(uri=feed_uri(gdc, "groups")))
     for entry in feed.entry:
         print("Group Name: "+entry.title.text)
         print("Atom Id: "+entry.id.text+"\n")
@@ -516,20 +2343,270 @@ def lookup_contact(acct, contact_id):
     in the BBDB file looks borked, pass it's google id in here and you can print the
     raw XML data returned from Google for that contact.
     """
-    gdc = gdata.contacts.client.ContactsClient(source='charrington')
-    gdc.ClientLogin(acct["login"], acct["password"], gdc.source)
-    return gdc.GetContact(contact_id)
+    if "server" in acct:
+        # ids always name Google's server, so fetch the contact from the account's own server instead
+        contact_id = acct["server"] + "/" + contact_id.split("://", 1)[1].split("/", 1)[1]
+    return with_session(acct, lambda gdc: gdc.GetContact(contact_id))
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Download Google Contacts into BBDB")
-    parser.add_argument("-g", "--show-groups", action="store_true", help="Display information on contact groups.")
-    parser.add_argument("-c", "--contact", help="View raw XML returned by Google Contacts API for a given contact ID.")
-    parser.add_argument("-m", "--mutt", action="store_true", help="Write output in Mutt alias format instead of BBDB")
-    args = parser.parse_args()
+def read_contact_ids(args):
+    """Return the contact ids given to -c, in order, and the errors for arguments that weren't.
+
+    Arguments that aren't ids name a file to read them from (- meaning stdin). That can
+    be a BBDB file written by charrington, in which case the ids are taken from its
+    google-id notes, or anything else with one id per line. An argument that's neither
+    (e.g., a mistyped id) gives an error instead.
+    """
+    ids = []
+    errors = []
+    for arg in args:
+        if "://" in arg:
+            ids.append(arg)
+            continue
+        if arg == "-":
+            text = sys.stdin.read()
+        else:
+            try:
+                with open(arg) as f:
+                    text = f.read()
+            except IOError as e:
+                errors.append("No such file or contact ID: {} ({})".format(arg, e.strerror))
+                continue
+        found = BBDB_GOOGLE_ID.findall(text)
+        ids += found or [line.strip() for line in text.splitlines() if line.strip()]
+    return ids, errors
+
+
+def lookup_contacts(accts, contact_ids, workers):
+    """Fetch the raw entries for a list of contact ids, yielding (id, entry, error) in order.
+
+    Each id is matched to its account by the login in it, and the entries are fetched
+    concurrently by a pool of worker threads, logging in once for every account that's
+    needed. Each id yields either the entry or, if it couldn't be fetched (or doesn't
+    belong to any configured account), the error explaining why.
+    """
+    # like in fetch_all, only imported when it's needed (see GoogleBackend)
+    from multiprocessing.pool import ThreadPool
+
+    accounts = dict((acct["login"], acct) for acct in accts)
+
+    def fetch(contact_id):
+        acct = accounts.get(google_id_login(contact_id))
+        if acct is None:
+            return None, "No matching account to query for contact: " + contact_id
+        try:
+            return lookup_contact(acct, contact_id), None
+        except google().RequestError as e:
+            return None, "Couldn't fetch contact {}: {}".format(contact_id, e)
+
+    # the same id asked for twice is only fetched once
+    unique = list(OrderedDict.fromkeys(contact_ids))
+    pool = ThreadPool(max(1, min(workers, len(unique))))
+    try:
+        results = dict(zip(unique, pool.map(fetch, unique)))
+    finally:
+        pool.close()
+        pool.join()
+    for contact_id in contact_ids:
+        entry, error = results[contact_id]
+        yield contact_id, entry, error
+
+
+def sync(args, accts):
+    """Fetch the contacts (or load them from the local store) and write the requested output."""
+    if args.offline:
+        # rebuild everything from the local store instead of asking Google
+        with stats.phase("local store"):
+            saved = load_store()
+        if saved is None:
+            sys.exit("No saved contacts found; run charrington once without --offline first.")
+        groups, contacts = saved
+    elif not args.merge_duplicates:
+        # the contacts are sorted as they arrive, and streamed from the sorted runs into
+        # the local store and then the outputs, so memory use is set by --sort-budget
+        groups, runs = fetch_all(accts, args.workers, args.page_size, args.incremental, args.sort_budget)
+        try:
+            with stats.phase("sort"):
+                runs.sort()
+            save_store(groups, runs)
+            with stats.phase("format"):
+                write_outputs(runs.contacts(), args.targets, args.jobs)
+        finally:
+            runs.close()
+        return
+    else:
+        # merging duplicates needs every contact at once, so fetch them all into a list
+        # and keep a copy locally
+        groups, contacts = fetch_all(accts, args.workers, args.page_size, args.incremental)
+        save_store(groups, contacts)
+
+    if args.merge_duplicates:
+        with stats.phase("merge duplicates"):
+            contacts = merge_duplicates(contacts)
+
+    # sort and remove dups
+    with stats.phase("sort"):
+        contacts.sort(key=lambda x: x.last_name.lower())
+    with stats.phase("format"):
+        write_outputs(contacts, args.targets, args.jobs)
+
+
+def log(message):
+    """Write a timestamped message to stderr (used by the daemon)."""
+    sys.stderr.write("{} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), message))
+
+
+class Daemon(object):
+    """Keeps the outputs up to date by polling each account for changes (see --daemon).
+
+    Everything is driven by a sched event queue. Each account is polled on its own
+    schedule (every --interval seconds, or its own "interval" option), and every poll is
+    an incremental sync (see sync_group_contacts) using the account's logged in client,
+    both of which are kept for as long as the daemon runs, as are the parsed contacts of
+    every group. When a poll finds that something changed, the outputs are rewritten
+    once all the polls due at that time are done; otherwise they're left alone.
+
+    A SIGHUP makes the daemon reread ~/.charringtonrc, log in again to accounts whose
+    settings changed, and poll every account right away.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.events = sched.scheduler(time.time, self.sleep)
+        self.accounts = OrderedDict()
+        self.polls = {}
+        self.groups = {}
+        self.contacts = {}
+        self.write_event = None
+        self.reload_requested = False
+
+    def run(self):
+        keep_sync_states()
+        signal.signal(signal.SIGHUP, self.request_reload)
+        self.reload()
+        if not self.accounts:
+            sys.exit("No accounts configured in ~/.charringtonrc.")
+        self.events.run()
+
+    def request_reload(self, signum, frame):
+        # don't touch the event queue from a signal handler; sleep picks this up
+        self.reload_requested = True
+
+    def sleep(self, seconds):
+        # a signal cuts time.sleep short, so a reload doesn't wait for the next poll
+        if not self.reload_requested:
+            time.sleep(seconds)
+        if self.reload_requested:
+            self.reload_requested = False
+            self.events.enter(0, 0, self.reload, ())
+
+    def reload(self):
+        """Read the configuration, and poll every account right away."""
+        accts = OrderedDict((acct["login"], acct) for acct in get_accounts(load_config()))
+        scheduler.configure(self.args.workers, accts.values())
+        for login, acct in self.accounts.items():
+            if accts.get(login) != acct:
+                # removed, or its password, server or groups changed
+                if login in _sessions:
+                    drop_session(acct, _sessions[login])
+                self.groups.pop(login, None)
+                for group in acct.get("groups", []):
+                    self.contacts.pop((login, group), None)
+        for event in self.polls.values():
+            self.events.cancel(event)
+        self.polls = {}
+        self.accounts = accts
+        log("Watching {} account(s)".format(len(accts)))
+        for login in accts:
+            self.polls[login] = self.events.enter(0, 1, self.poll, (login,))
+        self.schedule_write()
+
+    def poll(self, login):
+        """Bring an account's contacts up to date, and schedule its next poll."""
+        acct = self.accounts[login]
+        changed = False
+        try:
+            groups = get_all_contact_groups(acct)
+            old_groups = self.groups.get(login)
+            renamed = old_groups is None or (dict((href, g.name) for href, g in groups.items()) !=
+                                             dict((href, g.name) for href, g in old_groups.items()))
+            for group in acct["groups"]:
+                previous = None if renamed else self.contacts.get((login, group))
+                contacts = with_session(acct, lambda gdc: sync_group_contacts(gdc, acct, group, groups,
+                                                                              self.args.page_size, previous))
+                changed = changed or contacts is not previous
+                self.contacts[(login, group)] = contacts
+            self.groups[login] = groups
+        except (google().Error, google().HTTPException, socket.error) as e:
+            log("Account {}: sync failed, will try again later ({})".format(acct["name"], e))
+        except (IOError, OSError, ValueError) as e:
+            # saving (or reading) the sync state failed, e.g., a full disk or a damaged state file
+            log("Account {}: saving the sync state failed, will try again later ({})".format(acct["name"], e))
+        if changed:
+            log("Account {}: contacts changed".format(acct["name"]))
+            self.schedule_write()
+        self.polls[login] = self.events.enter(acct.get("interval", self.args.interval), 1, self.poll, (login,))
+
+    def schedule_write(self, delay=0):
+        # writes have a lower priority than polls, so polls due at the same time all go first
+        if self.write_event is None:
+            self.write_event = self.events.enter(delay, 2, self.write, ())
+
+    def write(self):
+        """Write the outputs from the contacts of every account."""
+        self.write_event = None
+        if not self.groups:
+            # no account has synced yet (e.g., every poll failed); don't empty the outputs
+            return
+        groups = {}
+        contacts = []
+        for login, acct in self.accounts.items():
+            if login not in self.groups:
+                continue
+            groups.update(self.groups[login])
+            for group in acct["groups"]:
+                contacts += self.contacts.get((login, group), [])
+        try:
+            save_store(groups, contacts)
+            if self.args.merge_duplicates:
+                contacts = merge_duplicates(contacts)
+            contacts.sort(key=lambda x: x.last_name.lower())
+            written = write_outputs(contacts, self.args.targets, self.args.jobs)
+        except (IOError, OSError, sqlite3.Error) as e:
+            # e.g., a full disk or a read-only output; the outputs are left as they were
+            log("Writing the outputs failed, will try again later ({})".format(e))
+            self.schedule_write(self.args.interval)
+            return
+        log("Wrote {} contacts".format(written))
+
+
+def output_targets(args):
+    """Return the (format, path) pairs of the outputs asked for on the command line.
+
+    Outputs without a PATH of their own have the path STDOUT. With no outputs given,
+    BBDB output is written to stdout, as always.
+    """
+    targets = [(fmt, getattr(args, fmt)) for fmt in WRITERS if getattr(args, fmt)]
+    if args.merge:
+        targets.append(("merge", args.merge))
+    return targets or [("bbdb", STDOUT)]
+
+
+def run(args):
+    """Carry out whatever the command line asked for."""
+    if args.query is not None:
+        # answer from the local index only, so that this is fast enough for Mutt to call
+        matches = query_contacts(args.query)
+        if matches is None:
+            sys.exit("No saved contacts found; run charrington once to build the index.")
+        print("Searching charrington's contacts... {} matches".format(len(matches)))
+        for email, name, info in matches:
+            print(u"{}\t{}\t{}".format(email, name, info or u"").encode("utf-8"))
+        exit(0 if matches else 1)
 
     cp = load_config()
     accts = get_accounts(cp)
+    scheduler.configure(args.workers, accts)
+    response_cache.configure(args.cache_size << 20)
 
     if args.show_groups:
         for acct in accts:
@@ -543,35 +2620,106 @@ if __name__ == "__main__":
         exit(0)
 
     elif args.contact:
-        # figure out which account to query based on the login field in the Id URI
-        pat = re.compile("http://www.google.com/m8/feeds/contacts/([^/]+)/")
-        match = pat.match(args.contact)
-        if match:
-            login = match.group(1).replace("%40", "@")
-            for acct in accts:
-                if acct["login"] == login:
-                    print(lookup_contact(acct, args.contact))
-                    exit(0)
-            print("No matching account to query for contact: "+args.contact)
+        contact_ids, errors = read_contact_ids(args.contact)
+        for error in errors:
+            print(error)
+        failed = bool(errors)
+        for contact_id, entry, error in lookup_contacts(accts, contact_ids, args.workers):
+            if error:
+                failed = True
+                print(error)
+            else:
+                print(entry)
+        exit(1 if failed else 0)
+
+    elif args.daemon:
+        Daemon(args).run()
 
     else:
-        # build a map of all groups (across all accounts)
-        # note that if you have groups with the same name in different accounts, they will be merged
-        # in the generated bbdb file
-        groups = {}
-        for acct in accts:
-            acctgroups = get_all_contact_groups(acct)
-            for groupid, group in acctgroups.items():
-                groups[groupid] = group
+        sync(args, accts)
 
-        # build list of all contacts across all accounts
-        contacts = []
-        for acct in accts:
-            contacts += get_all_contacts(acct, groups)
 
-        # sort and remove dups
-        contacts.sort(key=lambda x: x.last_name.lower())
-        if args.mutt:
-            output_mutt_aliases(contacts)
-        else:
-            output_bbdb_file(contacts)
+def main():
+    parser = argparse.ArgumentParser(description="Download Google Contacts into BBDB")
+    parser.add_argument("-g", "--show-groups", action="store_true", help="Display information on contact groups.")
+    parser.add_argument("-c", "--contact", nargs="+", metavar="ID",
+                        help="View raw XML returned by Google Contacts API for the given contact IDs. Instead of "
+                             "an ID, give a file (or - for stdin) to read them from, such as a BBDB file.")
+    parser.add_argument("-m", "--mutt", nargs="?", const=STDOUT, metavar="PATH",
+                        help="Write output in Mutt alias format, to PATH if given (and stdout otherwise).")
+    parser.add_argument("--bbdb", nargs="?", const=STDOUT, metavar="PATH",
+                        help="Write output in BBDB format (the default), to PATH if given (and stdout otherwise). "
+                             "Can be combined with -m to write both from a single sync.")
+    parser.add_argument("-q", "--query", help="Look up addresses in the contacts saved by the last sync, "
+                                              "printing them in the format Mutt's query_command expects.")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Maximum number of concurrent requests to Google (default 8). Fewer are "
+                             "made while Google is throttling us.")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE,
+                        help="Number of contacts to request at a time from each group (default {}).".format(PAGE_SIZE))
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, metavar="MB",
+                        help="Most megabytes of feeds to keep on disk so unchanged ones aren't downloaded "
+                             "again (default {}, 0 to turn the cache off).".format(CACHE_SIZE))
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Only download contacts that changed since the last incremental sync.")
+    parser.add_argument("-o", "--offline", action="store_true",
+                        help="Regenerate the output from the contacts saved by the last sync, without using the network.")
+    parser.add_argument("-d", "--merge-duplicates", action="store_true",
+                        help="Combine contacts from different accounts that share an email address or phone "
+                             "number into one record.")
+    parser.add_argument("--output", metavar="PATH",
+                        help="Write the output that would go to stdout to PATH instead (replacing it "
+                             "atomically, and only if it changed).")
+    parser.add_argument("--merge", metavar="BBDB_FILE",
+                        help="Update an existing BBDB file in place, rewriting only the records that changed.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to format BBDB output with (default 1). Only worth it for "
+                             "tens of thousands of contacts.")
+    parser.add_argument("--sort-budget", type=int, default=SORT_BUDGET, metavar="CONTACTS",
+                        help="Most contacts to hold in memory while sorting them (default {}); the rest are "
+                             "sorted in temporary files and merged while writing.".format(SORT_BUDGET))
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running, polling every account for changes and rewriting the outputs when "
+                             "something changed. Every output needs a PATH. Send SIGHUP to reload ~/.charringtonrc.")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, metavar="SECONDS",
+                        help="How often the daemon polls each account (default {}).".format(POLL_INTERVAL))
+    parser.add_argument("--stats", action="store_true",
+                        help="Print how long each phase of the run took, and what was fetched and written, on stderr.")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Profile the whole run with cProfile and save the results (for pstats) in FILE.")
+    args = parser.parse_args()
+    if args.merge and args.bbdb:
+        parser.error("--merge already writes BBDB output; --bbdb can't be used with it")
+    args.targets = output_targets(args)
+    if len([path for fmt, path in args.targets if path == STDOUT]) > 1:
+        parser.error("only one output can go to stdout; give the others a PATH")
+    if args.output and not any(path == STDOUT for fmt, path in args.targets):
+        parser.error("--output only applies to an output without a PATH of its own")
+    args.targets = [(fmt, args.output if path == STDOUT else path) for fmt, path in args.targets]
+    if args.sort_budget < 1:
+        parser.error("--sort-budget must be at least 1")
+    if args.daemon and any(path is None for fmt, path in args.targets):
+        parser.error("--daemon can't write to stdout; give every output a PATH (e.g., --bbdb ~/.bbdb)")
+    if args.daemon and args.offline:
+        parser.error("--daemon and --offline can't be used together")
+
+    if args.profile:
+        stats.profiles = []
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            # worker threads are profiled separately; fold their results into the main profile
+            profile = pstats.Stats(profiler)
+            for task_profiler in stats.profiles:
+                profile.add(task_profiler)
+            profile.dump_stats(args.profile)
+        if args.stats:
+            stats.report(sys.stderr)
+
+
+if __name__ == "__main__":
+    main()